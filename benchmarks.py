@@ -0,0 +1,348 @@
+"""
+    Benchmarks for the ORM hot paths
+
+    python benchmarks.py run --output baseline.json
+    python benchmarks.py run --output current.json
+    python benchmarks.py compare baseline.json current.json --threshold 0.1
+
+    The postgres and redis benchmarks use the same local databases and
+    'users' table as tests.py, and are skipped when they can't connect.
+
+    A benchmark's setup returns the function to time, or that function
+    and a teardown deleting what the setup created.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import psycopg2
+
+from regres import *
+
+
+benchmarks = []
+
+
+def benchmark(group):
+    def decorator(func):
+        benchmarks.append((group, func))
+        return func
+    return decorator
+
+
+def offline_table():
+    table = Table('users', None)
+    table._bind({'columns': ['id', 'name', 'age', 'created_at'], 'primary_key': 'id'})
+    return table
+
+
+class OfflineUser(Model):
+    table = offline_table()
+
+
+"""
+    Benchmarks that don't need a database
+"""
+
+
+@benchmark('core')
+def condition_composition():
+    t = OfflineUser.table
+    return lambda: ((t.age > 21) & (t.name == 'Ryan')) | ~(t.id.in_((1, 2, 3)))
+
+
+@benchmark('core')
+def query_compilation():
+    t = OfflineUser.table
+    query = t.query().where(name='Ryan', age__gt=21).order_by(t.id.desc()).limit(10).offset(20)
+    return lambda: query.query
+
+
+@benchmark('core')
+def model_construction():
+    return lambda: OfflineUser(name='Ryan', age=27)
+
+
+@benchmark('core')
+def model_hydration():
+    row = (1, 'Ryan', 27, datetime(2020, 1, 1))
+    return lambda: OfflineUser._from_row(row)
+
+
+@benchmark('core')
+def to_pickle():
+    user = OfflineUser(id=1, name='Ryan', age=27, created_at=datetime(2020, 1, 1))
+    return user.to_pickle
+
+
+@benchmark('core')
+def to_json():
+    user = OfflineUser(id=1, name='Ryan', age=27, created_at=datetime(2020, 1, 1))
+    return user.to_json
+
+
+"""
+    Benchmarks against a local postgres and redis
+"""
+
+
+def postgres_pool():
+    return SimpleConnectionPool(1, 1)
+
+
+def redis_conn():
+    import redis
+    conn = redis.Redis()
+    conn.ping()
+    return conn
+
+
+@benchmark('postgres')
+def model_save():
+    pool = postgres_pool()
+
+    class User(Model):
+        table = Table('users', pool)
+
+    user = User(name='Ryan', age=27)
+    user.save()
+    return user.save, lambda: cleanup(pool, user)
+
+
+@benchmark('postgres')
+def model_get():
+    pool = postgres_pool()
+
+    class User(Model):
+        table = Table('users', pool)
+
+    user = User(name='Ryan', age=27)
+    user.save()
+    return lambda: User.get(user.pk), lambda: cleanup(pool, user)
+
+
+@benchmark('redis')
+def redis_model_save():
+    class Pet(RedisModel):
+        conn = redis_conn()
+
+    pet = Pet(name='Leo', animal='Dog')
+    return pet.save, pet.delete
+
+
+@benchmark('redis')
+def redis_model_get():
+    class Pet(RedisModel):
+        conn = redis_conn()
+
+    pet = Pet(name='Leo', animal='Dog')
+    pet.save()
+    return lambda: Pet.get(pet.id), pet.delete
+
+
+@benchmark('redis')
+def hybrid_model_save():
+    pool = postgres_pool()
+
+    class HybridUser(HybridModel):
+        conn = redis_conn()
+        table = Table('users', pool)
+
+    user = HybridUser(name='Ryan', age=27)
+    user.save()
+    return user.save, lambda: cleanup(pool, user)
+
+
+@benchmark('redis')
+def hybrid_model_get():
+    pool = postgres_pool()
+
+    class HybridUser(HybridModel):
+        conn = redis_conn()
+        table = Table('users', pool)
+
+    user = HybridUser(name='Ryan', age=27)
+    user.save()
+    return lambda: HybridUser.get(user.pk), lambda: cleanup(pool, user)
+
+
+@benchmark('postgres')
+def schema_checksum():
+    pool = postgres_pool()
+    db = Database(pool)
+    return db.checksum, pool.closeall
+
+
+@benchmark('postgres')
+def schema_reflect():
+    pool = postgres_pool()
+    db = Database(pool)
+    return db.reflect, pool.closeall
+
+
+def cleanup(pool, *models):
+    """
+        Delete the rows (and redis keys) a benchmark created, so that
+        every run starts from the same tables.
+    """
+    for model in models:
+        model.delete()
+    pool.closeall()
+
+
+"""
+    Runner
+"""
+
+
+def unavailable():
+    """
+        @return: The exceptions meaning a benchmark's database or library
+            isn't available, the only ones a benchmark is skipped for.
+    """
+    errors = (ImportError, psycopg2.OperationalError)
+    try:
+        import redis
+    except ImportError:
+        return errors
+    return errors + (redis.ConnectionError,)
+
+
+def measure(func, repeat, min_time):
+    """
+        @return: The seconds per call of each repeat.
+            The number of calls per repeat is calibrated to take at least min_time.
+    """
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops *= 2
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        timings.append((time.perf_counter() - started) / loops)
+
+    return timings, loops
+
+
+def run(args):
+    results = dict()
+
+    for group, setup in benchmarks:
+        name = '{}.{}'.format(group, setup.__name__)
+        if args.only and not any([pattern in name for pattern in args.only]):
+            continue
+
+        try:
+            func = setup()
+        except unavailable() as e:
+            print("{:<40} skipped ({})".format(name, e.__class__.__name__), file=sys.stderr)
+            continue
+
+        teardown = None
+        if isinstance(func, tuple):
+            func, teardown = func
+
+        try:
+            timings, loops = measure(func, args.repeat, args.min_time)
+        finally:
+            if teardown is not None:
+                teardown()
+
+        results[name] = {
+            'median': statistics.median(timings),
+            'min': min(timings),
+            'mean': statistics.mean(timings),
+            'stdev': statistics.stdev(timings) if len(timings) > 1 else 0,
+            'loops': loops,
+            'repeat': len(timings)
+        }
+        print("{:<40} {:>12.3f} us".format(name, results[name]['median'] * 1e6))
+
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.now().isoformat(),
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    return 0
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    with open(args.current) as f:
+        current = json.load(f)['results']
+
+    regressions = []
+    for name in sorted(set(baseline) & set(current)):
+        before = baseline[name]['median']
+        after = current[name]['median']
+        change = (after - before) / before
+
+        flag = ''
+        if change > args.threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+
+        print("{:<40} {:>12.3f} us {:>12.3f} us {:>+8.1%} {}".format(name, before * 1e6, after * 1e6, change, flag))
+
+    for name in sorted(set(current) - set(baseline)):
+        print("{:<40} only in current".format(name))
+
+    # A benchmark that stopped running, e.g. because its setup now raises, fails too.
+    missing = sorted(set(baseline) - set(current))
+    for name in missing:
+        print("{:<40} MISSING".format(name))
+
+    if regressions:
+        print("\n{} regression(s) past {:.0%}".format(len(regressions), args.threshold))
+    if missing:
+        print("\n{} benchmark(s) missing from the current results".format(len(missing)))
+    if regressions or missing:
+        return 1
+
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ORM hot paths")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = subparsers.add_parser('run', help="Run the benchmarks")
+    parser_run.add_argument('--output', help="Write the results to this JSON file")
+    parser_run.add_argument('--only', nargs='+', help="Only run benchmarks whose name contains one of these")
+    parser_run.add_argument('--repeat', type=int, default=7)
+    parser_run.add_argument('--min-time', type=float, default=0.1, help="Minimum seconds per repeat")
+    parser_run.set_defaults(func=run)
+
+    parser_compare = subparsers.add_parser('compare', help="Compare two results files")
+    parser_compare.add_argument('baseline')
+    parser_compare.add_argument('current')
+    parser_compare.add_argument('--threshold', type=float, default=0.1, help="Allowed slowdown, 0.1 is 10%%")
+    parser_compare.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,3 @@
 from .models import RedisModel, Model, HybridModel
+from .sessions import Session, transaction
 from .sql import *
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+    Command line interface
+
+    python -m regres warm myapp.models:User --batch-size 500 --rate 5000
+"""
+
+import argparse
+import importlib
+import sys
+
+
+def load_model(path):
+    """
+        @param path: A dotted path in the form 'package.module:ClassName'
+    """
+    module_name, _, class_name = path.partition(':')
+    if not class_name:
+        raise argparse.ArgumentTypeError("model must be in the form 'module:ClassName'")
+
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+
+def parse_id(value):
+    # Primary keys are usually integers, and they need to compare as
+    # integers for --after to resume in the same order they were written.
+    return int(value) if value.isdigit() else value
+
+
+def warm(args):
+    model = load_model(args.model)
+
+    ids = args.ids
+    if args.ids_file:
+        with open(args.ids_file) as f:
+            ids = [parse_id(line.strip()) for line in f if line.strip()]
+
+    def progress(pk):
+        print(pk, flush=True)
+
+    model.warm(
+        ids,
+        batch_size=args.batch_size,
+        rate=args.rate,
+        after=args.after,
+        expire=args.expire,
+        callback=progress
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='regres')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_warm = subparsers.add_parser(
+        'warm',
+        help="Load a HybridModel's rows into redis. "
+            "Prints the last primary key of each batch so an interrupted run can be resumed with --after."
+    )
+    parser_warm.add_argument('model', help="The HybridModel to warm, e.g. 'myapp.models:User'")
+    parser_warm.add_argument('--ids', nargs='+', type=parse_id, help="Only warm these primary keys")
+    parser_warm.add_argument('--ids-file', help="A file with one primary key per line")
+    parser_warm.add_argument('--after', type=parse_id, help="Resume after this primary key")
+    parser_warm.add_argument('--batch-size', type=int, default=1000)
+    parser_warm.add_argument('--rate', type=float, default=None, help="Maximum rows per second")
+    parser_warm.add_argument('--expire', type=int, default=None)
+    parser_warm.set_defaults(func=warm)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,9 +3,19 @@ from decimal import Decimal
 from functools import reduce
 import hashlib
 import json 
+import logging
 import pickle
+import time as _time
 import uuid
 
+from .sessions import Session
+from .sql import Query
+from .sql.instrumentation import aredis_call, redis_call, traced
+from .sql.timeouts import StatementTimeout, statement_timeout
+
+
+logger = logging.getLogger('regres')
+
 
 class ObjectDoesNotExist(Exception):
     pass
@@ -62,6 +72,7 @@ class SerializableObject:
 class RedisModel(SerializableObject):
 
     conn = None
+    async_conn = None
     expire = None
 
     """
@@ -87,47 +98,97 @@ class RedisModel(SerializableObject):
     def _conn(self):
         return self.__class__.conn
 
+    @property
+    def _async_conn(self):
+        return self.__class__.async_conn
+
     @property
     def _expire(self):
         return self.__class__.expire
 
+    @property
+    def _key(self):
+        return self._redis_key(self.id)
+
     """
         Instance Methods
     """
 
+    @traced
     def delete(self):
         return self._delete_from_redis()
 
+    @traced
     def save(self, expire=None):
         return self._save_to_redis(expire)
 
+    @traced
+    async def adelete(self):
+        return await self._adelete_from_redis()
+
+    @traced
+    async def asave(self, expire=None):
+        return await self._asave_to_redis(expire)
+
     def _delete_from_redis(self):
-        return self._conn.delete(hash(self))
+        return redis_call('DEL', self._conn.delete, self._key)
 
     def _save_to_redis(self, expire=None):
         expire = expire or self._expire
-        return self._conn.set(hash(self), self.to_pickle(), ex=expire)
+        return redis_call('SET', self._conn.set, self._key, self.to_pickle(), ex=expire)
+
+    async def _adelete_from_redis(self):
+        return await aredis_call('DEL', self._async_conn.delete, self._key)
+
+    async def _asave_to_redis(self, expire=None):
+        expire = expire or self._expire
+        return await aredis_call('SET', self._async_conn.set, self._key, self.to_pickle(), ex=expire)
 
     """
         Class Methods
     """
 
     @classmethod
+    @traced
     def get(cls, id):
         return cls._get_from_redis(id)
 
+    @classmethod
+    @traced
+    async def aget(cls, id):
+        return await cls._aget_from_redis(id)
+
     @classmethod
     def _get_from_redis(cls, id):
-        key = hash((cls.__name__, id))
-        instance = cls.conn.get(key)
+        key = cls._redis_key(id)
+        instance = redis_call('GET', cls.conn.get, key)
         if instance:
             instance = cls.from_pickle(instance)
         return instance
 
+    @classmethod
+    async def _aget_from_redis(cls, id):
+        key = cls._redis_key(id)
+        instance = await aredis_call('GET', cls.async_conn.get, key)
+        if instance:
+            instance = cls.from_pickle(instance)
+        return instance
+
+    @classmethod
+    def _redis_key(cls, id):
+        # hash() of a str is salted per process, so it can't be used as a key
+        # that other processes (e.g. the warm command) need to agree on.
+        return "{}:{}".format(cls.__name__, id)
+
+
+# The first Model declared for each table, by (schema, name). Used by prefetch().
+_models = dict()
+
 
 class Model(SerializableObject):
 
     table = None
+    timeout = None
 
     """
         Magic Methods
@@ -137,6 +198,24 @@ class Model(SerializableObject):
         self.__dict__ = dict.fromkeys(self._table.column_names)
         self.__dict__.update(kwargs)
 
+    def __getattr__(self, name):
+        # Only called for attributes that don't exist, i.e. prefetched relations.
+        related = self.__dict__.get('_related', {})
+        if name in related:
+            return related[name]
+        raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, name))
+
+    def __getstate__(self):
+        # Prefetched relations aren't cached with the instance, they would go stale.
+        state = dict(self.__dict__)
+        state.pop('_related', None)
+        return state
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.table is not None:
+            _models.setdefault((cls.table._schema, cls.table._name), cls)
+
     def __getitem__(self, column):
         if column in self._table:
             return getattr(self, column.name)
@@ -146,6 +225,12 @@ class Model(SerializableObject):
     def __repr__(self):
         return '{}(pk={})'.format(self.__class__.__name__, repr(self.pk))
 
+    def to_dict(self):
+        # A copy, so the instance keeps its prefetched relations.
+        d = dict(super().to_dict())
+        d.pop('_related', None)
+        return d
+
     """
         Properties
     """
@@ -157,45 +242,119 @@ class Model(SerializableObject):
     def _table(self):
         return self.__class__.table
 
+    @property
+    def _session(self):
+        return Session.current(self._table._pool)
+
     """
         Instance Methods
     """
 
-    def delete(self):
-        return self._delete_from_postgres()
+    @traced
+    def delete(self, timeout=None):
+        session = self._session
+        if session is not None:
+            session.delete(self)
+            return True
 
-    def save(self):
-        return self._save_to_postgres()
+        with self._statement_timeout(timeout):
+            return self._delete_from_postgres()
+
+    @traced
+    def save(self, timeout=None):
+        session = self._session
+        if session is not None:
+            session.add(self)
+            return True
+
+        with self._statement_timeout(timeout):
+            return self._save_to_postgres()
+
+    @traced
+    async def adelete(self, timeout=None):
+        with self._statement_timeout(timeout):
+            return await self._adelete_from_postgres()
+
+    @traced
+    async def asave(self, timeout=None):
+        with self._statement_timeout(timeout):
+            return await self._asave_to_postgres()
 
     def _delete_from_postgres(self):
-        query = """
-            DELETE FROM %s 
-                WHERE %s
-        """
-        condition = self._table.primary_key == self.pk
-        args = (self._table, condition)
+        query, args = self._delete()
 
         try:
             self._table._pool.execute(query, args)
-            return True
+        except StatementTimeout:
+            raise
         except:
             return False
 
+        self._table._pool.after_commit(self._table._bump_version)
+        return True
+
     def _save_to_postgres(self):
-        if self.pk is None:
-            query, vars = self._insert()
-        else:
-            query, vars = self._update()
+        query, vars = self._save()
 
         try:
             values = self._table._pool.fetchone(query, vars)
             d = dict(zip(self._table.column_names, values))
             self.__dict__.update(d)
-            return True 
+        except StatementTimeout:
+            raise
         except Exception as e:
-            print(e)
+            logger.warning("could not save %s: %s", self.__class__.__name__, e)
             return False
 
+        self._table._pool.after_commit(self._table._bump_version)
+        return True
+
+    async def _adelete_from_postgres(self):
+        query, args = self._delete()
+
+        try:
+            await self._table._async_pool.execute(query, args)
+        except StatementTimeout:
+            raise
+        except:
+            return False
+
+        await self._table._abump_version()
+        return True
+
+    async def _asave_to_postgres(self):
+        query, vars = self._save()
+
+        try:
+            values = await self._table._async_pool.fetchone(query, vars)
+            d = dict(zip(self._table.column_names, values))
+            self.__dict__.update(d)
+        except StatementTimeout:
+            raise
+        except Exception as e:
+            logger.warning("could not save %s: %s", self.__class__.__name__, e)
+            return False
+
+        await self._table._abump_version()
+        return True
+
+    def _set_related(self, relation, instance):
+        self.__dict__.setdefault('_related', dict())[relation] = instance
+
+    def _delete(self):
+        query = """
+            DELETE FROM %s 
+                WHERE %s
+        """
+        condition = self._table.primary_key == self.pk
+        args = (self._table, condition)
+        return query, args
+
+    def _save(self):
+        if self.pk is None:
+            return self._insert()
+        return self._update()
+
     def _insert(self):
         query = """
             INSERT INTO %s %s
@@ -203,12 +362,15 @@ class Model(SerializableObject):
                 RETURNING *
         """
 
-        column_names = tuple([col for col in self._table if self[col] is not None])
-        values = tuple([self[col] for col in self._table if self[col] is not None])
+        columns = tuple([col for col in self._table if self[col] is not None])
+        values = tuple([self[col] for col in columns])
 
-        args = (self._table, column_names, values)
+        args = (self._table, columns, values)
         return query, args
 
+    def _insert_column_names(self):
+        return tuple([col.name for col in self._table if self[col] is not None])
+
     def _update(self):
         assignments = [col.assign(self[col]) for col in self._table]
         add = lambda x, y : x + y
@@ -234,15 +396,74 @@ class Model(SerializableObject):
     """
 
     @classmethod
-    def get(cls, id):
-        return cls._get_from_postgres(id)
+    @traced
+    def get(cls, id, timeout=None):
+        cls._autoflush()
+        with cls._statement_timeout(timeout):
+            return cls._get_from_postgres(id)
+
+    @classmethod
+    @traced
+    def get_many(cls, prefetch=(), timeout=None, **kwargs):
+        """
+            @param prefetch: A relation name or a tuple of them, see Query.prefetch()
+            @param timeout: Seconds each statement may run for, defaults to the model's timeout
+            @param **kwargs: column lookups, see Query.where()
+        """
+        cls._autoflush()
+        if isinstance(prefetch, str):
+            prefetch = (prefetch,)
+        return cls.query().where(**kwargs).prefetch(*prefetch).all(timeout)
+
+    @classmethod
+    def query(cls):
+        return Query(cls.table, model=cls)
+
+    @classmethod
+    @traced
+    async def aget(cls, id, timeout=None):
+        with cls._statement_timeout(timeout):
+            return await cls._aget_from_postgres(id)
+
+    @classmethod
+    @traced
+    async def aget_many(cls, prefetch=(), timeout=None, **kwargs):
+        """
+            See get_many()
+        """
+        if isinstance(prefetch, str):
+            prefetch = (prefetch,)
+        return await cls.query().where(**kwargs).prefetch(*prefetch).aall(timeout)
+
+    @classmethod
+    def _get_from_postgres(cls, id, pool=None):
+        """
+            @param pool: Defaults to the table's read pool
+        """
+        pool = cls.table._read_pool if pool is None else pool
+        query, args = cls._select(id)
+        values = pool.fetchall(query, args)
+        return cls._from_rows(values)
 
     @classmethod
-    def get_many(cls, **kwargs):
-        pass
+    async def _aget_from_postgres(cls, id):
+        query, args = cls._select(id)
+        values = await cls.table._async_pool.fetchall(query, args)
+        return cls._from_rows(values)
 
     @classmethod
-    def _get_from_postgres(cls, id):
+    def _statement_timeout(cls, timeout=None):
+        return statement_timeout(cls.timeout if timeout is None else timeout)
+
+    @classmethod
+    def _autoflush(cls):
+        # Write the models queued in a transaction so that reads see them.
+        session = Session.current(cls.table._pool)
+        if session is not None:
+            session.flush()
+
+    @classmethod
+    def _select(cls, id):
         query = """
             SELECT *
                 FROM %s
@@ -250,47 +471,279 @@ class Model(SerializableObject):
         """
         condition = cls.table.primary_key == id
         args = (cls.table, condition)
-        
-        values = cls.table._pool.fetchall(query, args)
+        return query, args
+
+    @classmethod
+    def _prefetch(cls, instances, relation, model=None):
+        fk, model, values = cls._relation(instances, relation, model)
+        related = model._get_related(fk.references, values)
+
+        for instance in instances:
+            instance._set_related(relation, related.get(getattr(instance, fk.column.name)))
+
+    @classmethod
+    async def _aprefetch(cls, instances, relation, model=None):
+        fk, model, values = cls._relation(instances, relation, model)
+        related = await model._aget_related(fk.references, values)
+
+        for instance in instances:
+            instance._set_related(relation, related.get(getattr(instance, fk.column.name)))
+
+    @classmethod
+    def _relation(cls, instances, relation, model=None):
+        """
+            @return: The ForeignKey of the relation, the Model to load it as,
+                and the values of its column in instances
+        """
+        fk = cls.table._relations().get(relation)
+        if fk is None or hasattr(cls, relation):
+            raise ValueError("'{}' is not a relation of table '{}'".format(relation, cls.table._name))
 
-        if len(values) == 0:
+        model = model or _models.get((fk.schema, fk.table_name))
+        if model is None:
+            raise ValueError("There is no Model for table '{}'".format(fk.table_name))
+
+        values = set([getattr(instance, fk.column.name) for instance in instances])
+        values.discard(None)
+        return fk, model, values
+
+    @classmethod
+    def _get_related(cls, column_name, values, pool=None):
+        """
+            @param pool: Defaults to the table's read pool
+            @return: A dict of column value to instance, for the rows whose column is in values
+        """
+        if not values:
+            return dict()
+
+        column = [col for col in cls.table if col.name == column_name][0]
+        query = cls.query().where(column.in_(tuple(values)))
+        if pool is None:
+            instances = query.all()
+        else:
+            instances = [cls._from_row(row) for row in pool.fetchall(query.query, query._args)]
+        return dict([(getattr(instance, column_name), instance) for instance in instances])
+
+    @classmethod
+    async def _aget_related(cls, column_name, values):
+        if not values:
+            return dict()
+
+        column = [col for col in cls.table if col.name == column_name][0]
+        instances = await cls.query().where(column.in_(tuple(values))).aall()
+        return dict([(getattr(instance, column_name), instance) for instance in instances])
+
+    @classmethod
+    def _from_row(cls, row):
+        d = dict(zip(cls.table.column_names, row))
+        return cls(**d)
+
+    @classmethod
+    def _from_rows(cls, rows):
+        if len(rows) == 0:
             raise ObjectDoesNotExist
 
-        elif len(values) > 1:
+        elif len(rows) > 1:
             raise MultipleObjectsReturned
 
-        keys = cls.table.column_names
-        values = values[0]
-        d = dict(zip(keys, values))
-        return cls(**d)
+        return cls._from_row(rows[0])
 
 
 class HybridModel(Model, RedisModel):
 
     conn = None
+    async_conn = None
     expire = None
     table = None
+    timeout = None
 
     def __hash__(self):
         return hash((self.__class__.__name__, self.pk))
 
-    def delete(self):
-        success = self._delete_from_postgres()
+    @property
+    def _key(self):
+        return self._redis_key(self.pk)
+
+    @traced
+    def delete(self, timeout=None):
+        success = super().delete(timeout)
         if success:
-            self._delete_from_redis()
+            # Inside a transaction, only once it has been committed.
+            self._table._pool.after_commit(self._delete_from_redis)
         return success
 
-    def save(self, expire=None):
-        success = self._save_to_postgres()
+    @traced
+    def save(self, expire=None, timeout=None):
+        success = super().save(timeout)
         if success:
-            self._save_to_redis(expire)
+            self._table._pool.after_commit(lambda: self._save_to_redis(expire))
+        return success
+
+    @traced
+    async def adelete(self, timeout=None):
+        with self._statement_timeout(timeout):
+            success = await self._adelete_from_postgres()
+        if success:
+            await self._adelete_from_redis()
+        return success
+
+    @traced
+    async def asave(self, expire=None, timeout=None):
+        with self._statement_timeout(timeout):
+            success = await self._asave_to_postgres()
+        if success:
+            await self._asave_to_redis(expire)
         return success
 
     @classmethod
-    def get(cls, id):
-        instance = cls._get_from_redis(id)
+    @traced
+    def get(cls, id, timeout=None):
+        # Inside a transaction redis can hold an older copy than the
+        # transaction's own writes, so the row is read from postgres.
+        instance = cls._get_from_redis(id) if cls.table._pool.pinned is None else None
+        if instance is None:
+            cls._autoflush()
+            # Read from the primary, a replica could return a row that was just deleted or updated.
+            with cls._statement_timeout(timeout):
+                instance = cls._get_from_postgres(id, cls.table._pool)
+            if instance is not None:
+                # Inside a transaction the row may not be committed yet.
+                cls.table._pool.after_commit(instance._save_to_redis)
+        return instance
+
+    @classmethod
+    @traced
+    async def aget(cls, id, timeout=None):
+        instance = await cls._aget_from_redis(id)
         if instance is None:
-            instance = cls._get_from_postgres(id)
+            with cls._statement_timeout(timeout):
+                instance = await cls._aget_from_postgres(id)
             if instance is not None:
-                instance._save_to_redis()
-        return instance
\ No newline at end of file
+                await instance._asave_to_redis()
+        return instance
+
+    @classmethod
+    def _get_related(cls, column_name, values):
+        if column_name != cls.table.primary_key.name or not values:
+            return super()._get_related(column_name, values)
+
+        ids = list(values)
+        instances = redis_call('MGET', cls.conn.mget, [cls._redis_key(id) for id in ids])
+        related = dict([(id, cls.from_pickle(instance)) for id, instance in zip(ids, instances) if instance])
+
+        missing = set(ids) - set(related)
+        if missing:
+            loaded = super()._get_related(column_name, missing, cls.table._pool)
+            # Inside a transaction the rows may not be committed yet.
+            cls.table._pool.after_commit(lambda: cls._save_many_to_redis(loaded.values()))
+            related.update(loaded)
+
+        return related
+
+    @classmethod
+    def _save_many_to_redis(cls, instances):
+        pipe = cls.conn.pipeline(transaction=False)
+        for instance in instances:
+            pipe.set(instance._key, instance.to_pickle(), ex=cls.expire)
+        redis_call('PIPELINE', pipe.execute)
+
+    @classmethod
+    async def _aget_related(cls, column_name, values):
+        if column_name != cls.table.primary_key.name or not values:
+            return await super()._aget_related(column_name, values)
+
+        ids = list(values)
+        instances = await aredis_call('MGET', cls.async_conn.mget, [cls._redis_key(id) for id in ids])
+        related = dict([(id, cls.from_pickle(instance)) for id, instance in zip(ids, instances) if instance])
+
+        missing = set(ids) - set(related)
+        if missing:
+            loaded = await super()._aget_related(column_name, missing)
+            pipe = cls.async_conn.pipeline(transaction=False)
+            for instance in loaded.values():
+                pipe.set(instance._key, instance.to_pickle(), ex=cls.expire)
+            await aredis_call('PIPELINE', pipe.execute)
+            related.update(loaded)
+
+        return related
+
+    @classmethod
+    @traced
+    def warm(cls, query_or_ids=None, batch_size=1000, rate=None, after=None, expire=None, callback=None):
+        """
+            Load rows from postgres into redis.
+            Rows are read in primary key order with one short keyset query per
+            batch (pk > last ORDER BY pk LIMIT batch_size), so no transaction
+            stays open while writing to redis or sleeping, and written to redis
+            with one pipeline per batch.
+            @param query_or_ids: A Query on the model's table without a limit or
+                an offset, an iterable of primary keys, or None to warm the whole table
+            @param batch_size: The number of rows fetched and written at a time
+            @param rate: The maximum number of rows written per second
+            @param after: Resume after this primary key
+            @param expire: Defaults to the model's expire
+            @param callback: Called with the last primary key of each batch
+            @return: The primary key of the last row written
+        """
+        expire = expire or cls.expire
+        last = after
+
+        for rows in cls._warm_batches(query_or_ids, batch_size, after):
+            started = _time.monotonic()
+
+            pipe = cls.conn.pipeline(transaction=False)
+            for row in rows:
+                instance = cls._from_row(row)
+                pipe.set(instance._key, instance.to_pickle(), ex=expire)
+            redis_call('PIPELINE', pipe.execute)
+
+            last = instance.pk
+            if callback is not None:
+                callback(last)
+
+            if rate:
+                elapsed = _time.monotonic() - started
+                _time.sleep(max(0, len(rows) / rate - elapsed))
+
+        return last
+
+    @classmethod
+    def _warm_batches(cls, query_or_ids, batch_size, after):
+        pk = cls.table.primary_key
+
+        if query_or_ids is None:
+            queries = [cls.table.query()]
+        elif isinstance(query_or_ids, Query):
+            # Every window is limited and sorted by primary key, so the query's
+            # own limit and offset would apply to each window, not to the result.
+            if query_or_ids._count or query_or_ids._start:
+                raise ValueError("warm() doesn't support queries with a limit or an offset")
+            queries = [query_or_ids]
+        else:
+            ids = sorted(query_or_ids)
+            if after is not None:
+                ids = [id for id in ids if id > after]
+                after = None
+            chunks = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+            queries = [cls.table.query().where(pk.in_(tuple(chunk))) for chunk in chunks]
+
+        index = cls.table.column_names.index(pk.name)
+
+        for query in queries:
+            last = after
+            while True:
+                window = query if last is None else query.where(pk > last)
+                window = window.limit(batch_size)
+                window._sort_expressions = [pk.asc()]
+
+                # Each window is its own transaction, committed before the rows are yielded.
+                rows = cls.table._pool.fetchall(window.query, window._args)
+                if not rows:
+                    break
+
+                yield rows
+
+                if len(rows) < batch_size:
+                    break
+                last = rows[-1][index]
+
@@ -0,0 +1,157 @@
+from contextlib import contextmanager
+import threading
+
+from psycopg2.extras import execute_batch, execute_values
+
+from .sql.instrumentation import statement_template
+from .sql.pools import run_callbacks
+
+
+_local = threading.local()
+
+
+class Session:
+    """
+        A unit of work on a single connection.
+
+        Models saved or deleted while a session is active on their table's
+        pool are queued instead of written, and flushed together when the
+        session commits: inserts and deletes as one statement per table,
+        updates as one round trip per table.
+        Redis writes of HybridModels only happen after the commit succeeds.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._saves = dict()
+        self._deletes = dict()
+        self._after_commit = list()
+
+    def __repr__(self):
+        return "{}(saves={}, deletes={})".format(self.__class__.__name__, len(self._saves), len(self._deletes))
+
+    @classmethod
+    def current(cls, pool):
+        """
+            @return: The innermost session on this thread using the pool, if any.
+        """
+        for session in reversed(getattr(_local, 'sessions', [])):
+            if session.pool is pool:
+                return session
+        return None
+
+    def add(self, model, after_commit=None):
+        """
+            Queue a model to be inserted or updated.
+            @param after_commit: Called once the transaction has been committed
+        """
+        self._deletes.pop(id(model), None)
+        self._saves[id(model)] = model
+        if after_commit is not None:
+            self.on_commit(after_commit)
+
+    def delete(self, model, after_commit=None):
+        """
+            Queue a model to be deleted.
+            @param after_commit: Called once the transaction has been committed
+        """
+        self._saves.pop(id(model), None)
+        if model.pk is not None:
+            self._deletes[id(model)] = model
+        if after_commit is not None:
+            self.on_commit(after_commit)
+
+    def on_commit(self, callback):
+        self._after_commit.append(callback)
+
+    def flush(self):
+        """
+            Write the queued models without committing.
+        """
+        saves = list(self._saves.values())
+        deletes = list(self._deletes.values())
+        self._saves.clear()
+        self._deletes.clear()
+
+        if not saves and not deletes:
+            return
+
+        inserts = group_by(saves, lambda m: (m._table, m._insert_column_names()) if m.pk is None else None)
+        updates = group_by(saves, lambda m: (m._table, m._update()[0]) if m.pk is not None else None)
+        removals = group_by(deletes, lambda m: m._table)
+
+        with self.pool.cursor() as cur:
+            for (table, column_names), models in inserts.items():
+                self._flush_inserts(cur, table, column_names, models)
+
+            for (table, query), models in updates.items():
+                args = [model._update()[1] for model in models]
+                with statement_template(query, sum([len(a) for a in args])):
+                    execute_batch(cur, query, args, page_size=len(args))
+
+            for table, models in removals.items():
+                query = "DELETE FROM %s WHERE %s"
+                condition = table.primary_key.in_(tuple([model.pk for model in models]))
+                cur.execute(query, (table, condition))
+
+        tables = set([model._table for model in saves + deletes])
+        for table in tables:
+            self.on_commit(table._bump_version)
+
+    def _flush_inserts(self, cur, table, column_names, models):
+        query = "INSERT INTO {} ({}) VALUES %s RETURNING *".format(
+            table,
+            ', '.join(['"{}"'.format(name) for name in column_names])
+        )
+        values = [tuple([getattr(model, name) for name in column_names]) for model in models]
+
+        # Postgres returns the rows of a multi-row insert in the order of VALUES.
+        with statement_template(query, len(values) * len(column_names)):
+            rows = execute_values(cur, query, values, page_size=len(values), fetch=True)
+        for model, row in zip(models, rows):
+            model.__dict__.update(zip(table.column_names, row))
+
+    def _committed(self):
+        callbacks = self._after_commit
+        self._after_commit = list()
+        run_callbacks(callbacks)
+
+
+def group_by(items, key):
+    groups = dict()
+    for item in items:
+        k = key(item)
+        if k is not None:
+            groups.setdefault(k, []).append(item)
+    return groups
+
+
+@contextmanager
+def transaction(pool):
+    """
+        Open a Session on the pool.
+        The queued models are flushed and committed when the block exits,
+        or discarded if it raises. Nested transactions join the outer one.
+
+        with transaction(pool) as session:
+            user.save()
+            pet.delete()
+    """
+    session = Session.current(pool)
+    if session is not None:
+        yield session
+        return
+
+    session = Session(pool)
+    sessions = _local.__dict__.setdefault('sessions', [])
+
+    with pool.transaction():
+        sessions.append(session)
+        try:
+            yield session
+            session.flush()
+        finally:
+            sessions.remove(session)
+
+        # Inside an outer pool.transaction(), nothing is committed until it exits.
+        pool.after_commit(session._committed)
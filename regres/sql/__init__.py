@@ -1,3 +1,6 @@
+from .databases import Database
 from .tables import Table
 from .queries import Query
-from .pools import SimpleConnectionPool, ThreadedConnectionPool
\ No newline at end of file
+from .plans import Plan, PlanCapture
+from .timeouts import StatementTimeout, deadline, statement_timeout
+from .pools import AsyncPool, ConnectionPool, PoolTimeout, ReplicatedPool, SimpleConnectionPool, ThreadedConnectionPool
\ No newline at end of file
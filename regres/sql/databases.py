@@ -0,0 +1,151 @@
+import json
+import os
+import tempfile
+import threading
+
+from .tables import Table, reflect
+
+
+class Database:
+    """
+        A schema whose tables are reflected together.
+
+        Tables returned by table() are bound the first time one of them is
+        used, with a single query for the whole schema. With a `snapshot`
+        file the result of that query is saved to disk, and later processes
+        load it instead, as long as the schema's checksum hasn't changed.
+    """
+
+    # Any DDL that renames a table or changes a column or a constraint
+    # writes a new version of its catalog row, with a newer xmin, and
+    # dropping one removes rows.
+    # Aggregating the xmins is much cheaper than reflect(): no string is
+    # built per column, nothing is sorted and no subquery runs per row.
+    checksum_query = """
+        SELECT concat_ws(':', count(*), max(x), sum(x))
+            FROM (
+                SELECT c.xmin::text::bigint AS x
+                    FROM pg_catalog.pg_class AS c
+                    WHERE c.relnamespace = (SELECT oid FROM pg_catalog.pg_namespace WHERE nspname = %(schema)s)
+                        AND c.relkind IN ('r', 'v', 'm', 'p', 'f')
+                UNION ALL
+                SELECT a.xmin::text::bigint
+                    FROM pg_catalog.pg_attribute AS a
+                        JOIN pg_catalog.pg_class AS c
+                            ON c.oid = a.attrelid
+                    WHERE c.relnamespace = (SELECT oid FROM pg_catalog.pg_namespace WHERE nspname = %(schema)s)
+                        AND c.relkind IN ('r', 'v', 'm', 'p', 'f')
+                        AND a.attnum > 0
+                UNION ALL
+                SELECT f.xmin::text::bigint
+                    FROM pg_catalog.pg_constraint AS f
+                    WHERE f.connamespace = (SELECT oid FROM pg_catalog.pg_namespace WHERE nspname = %(schema)s)
+                        AND f.contype IN ('p', 'f')
+            ) AS versions
+    """
+
+    def __init__(self, pool, schema='public', conn=None, async_pool=None, snapshot=None, async_conn=None):
+        """
+            @param pool: The connection pool used by the tables
+            @param schema: The schema to reflect
+            @param conn: An optional redis connection passed to the tables
+            @param async_pool: An optional AsyncPool passed to the tables
+            @param snapshot: An optional path of a file to persist the reflected schema in
+            @param async_conn: An optional asyncio redis connection passed to the tables
+        """
+        self._pool = pool
+        self._schema = schema
+        self._conn = conn
+        self._async_pool = async_pool
+        self._async_conn = async_conn
+        self._snapshot = snapshot
+        self._tables = dict()
+        self._metadata_by_name = None
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        return self.table(name)
+
+    def __repr__(self):
+        return "{}(schema={})".format(self.__class__.__name__, repr(self._schema))
+
+    def table(self, name):
+        """
+            @return: The Table with this name, no query is made until it is used.
+        """
+        if name not in self._tables:
+            self._tables[name] = Table(
+                name,
+                self._pool,
+                schema=self._schema,
+                conn=self._conn,
+                async_pool=self._async_pool,
+                database=self,
+                async_conn=self._async_conn
+            )
+        return self._tables[name]
+
+    def checksum(self):
+        """
+            @return: A value that changes whenever a column or a key of the schema does.
+        """
+        row = self._pool.fetchone(self.checksum_query, {'schema': self._schema})
+        return row[0]
+
+    def reflect(self):
+        """
+            Load the metadata of every table in the schema, from the snapshot
+            if it is still valid, and bind the tables created so far.
+        """
+        with self._lock:
+            checksum = self.checksum() if self._snapshot is not None else None
+            metadata = self._load_snapshot(checksum)
+
+            if metadata is None:
+                metadata = reflect(self._pool, self._schema)
+                self._save_snapshot(metadata, checksum)
+
+            self._metadata_by_name = metadata
+
+        for name, table in self._tables.items():
+            if name in metadata:
+                table._bind(metadata[name])
+
+        return metadata
+
+    def _metadata(self, name):
+        if self._metadata_by_name is None:
+            self.reflect()
+        return self._metadata_by_name.get(name)
+
+    def _load_snapshot(self, checksum):
+        if self._snapshot is None or not os.path.exists(self._snapshot):
+            return None
+
+        try:
+            with open(self._snapshot) as f:
+                snapshot = json.load(f)
+        except ValueError:
+            return None
+
+        if snapshot.get('schema') != self._schema or snapshot.get('checksum') != checksum:
+            return None
+
+        return snapshot['tables']
+
+    def _save_snapshot(self, metadata, checksum):
+        if self._snapshot is None:
+            return
+
+        snapshot = {
+            'schema': self._schema,
+            'checksum': checksum,
+            'tables': metadata
+        }
+
+        # Write to a temporary file first so other workers never read a partial snapshot.
+        directory = os.path.dirname(os.path.abspath(self._snapshot))
+        fd, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path, self._snapshot)
@@ -0,0 +1,410 @@
+"""
+    Hooks called after every SQL statement and Redis call made by regres.
+
+    def hook(event):
+        print(event.model, event.method, event.statement, event.duration)
+
+    add_hook(hook)
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import inspect
+import logging
+import time
+
+from psycopg2.extensions import cursor as BaseCursor
+
+from .columns import Column
+from .expressions import Expression
+
+
+logger = logging.getLogger('regres')
+
+_hooks = []
+_origin = ContextVar('regres_origin', default=(None, None))
+_wait = ContextVar('regres_wait', default=None)
+_template = ContextVar('regres_template', default=None)
+_request = ContextVar('regres_request', default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class Event:
+    """
+        @attr kind: 'sql' or 'redis'
+        @attr statement: The SQL with its values replaced by %s, or the Redis command
+        @attr params: The number of values sent with the statement
+        @attr rows: The number of rows returned or affected, if known
+        @attr duration: Seconds spent running the statement
+        @attr wait: Seconds spent waiting for a pooled connection, if any
+        @attr model: The name of the Model the statement was made for, if any
+        @attr method: The name of the Model method the statement was made for, if any
+        @attr error: The exception raised by the statement, if any
+        @attr query: The query exactly as it was passed to the cursor, for SQL events
+        @attr vars: The vars exactly as they were passed to the cursor, for SQL events
+    """
+
+    def __init__(self, kind, statement, params=0, rows=None, duration=0, wait=None, model=None, method=None, error=None,
+            query=None, vars=None):
+        self.kind = kind
+        self.statement = statement
+        self.params = params
+        self.rows = rows
+        self.duration = duration
+        self.wait = wait
+        self.model = model
+        self.method = method
+        self.error = error
+        self.query = query
+        self.vars = vars
+
+    def __repr__(self):
+        return "{}(kind={}, statement={}, duration={:.6f})".format(
+            self.__class__.__name__, repr(self.kind), repr(self.statement), self.duration
+        )
+
+
+def add_hook(hook):
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def emit(kind, statement, params=0, rows=None, duration=0, error=None, query=None, vars=None):
+    request = _request.get()
+    if not _hooks and request is None:
+        return
+
+    model, method = _origin.get()
+    event = Event(kind, statement, params, rows, duration, _wait.get(), model, method, error, query, vars)
+
+    for hook in list(_hooks):
+        hook(event)
+
+    if request is not None:
+        request._record(event)
+
+
+"""
+    Origin
+"""
+
+
+@contextmanager
+def origin(model, method):
+    """
+        Attribute the statements run inside the block to a model's method.
+        The outermost origin wins, so a Model method calling another one is
+        reported as the method the caller used.
+    """
+    if _origin.get()[0] is not None:
+        yield
+        return
+
+    token = _origin.set((model, method))
+    try:
+        yield
+    finally:
+        _origin.reset(token)
+
+
+def traced(func):
+    """
+        Decorator for Model methods, see origin().
+    """
+    name = func.__name__
+
+    def model_name(obj):
+        return obj.__name__ if isinstance(obj, type) else obj.__class__.__name__
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(obj, *args, **kwargs):
+            with origin(model_name(obj), name):
+                return await func(obj, *args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrapper(obj, *args, **kwargs):
+            with origin(model_name(obj), name):
+                return func(obj, *args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def waited(seconds):
+    """
+        Used by the pools around a checkout, with the time it waited for a
+        connection. Events emitted outside of a checkout have no wait.
+    """
+    token = _wait.set(seconds)
+    try:
+        yield
+    finally:
+        _wait.reset(token)
+
+
+"""
+    SQL
+"""
+
+
+def statement_shape(query, vars=None):
+    """
+        @return: The statement with every value replaced by %s, and the number of values.
+            Tables, Columns and Expressions are kept so that two statements
+            only differing by their values have the same shape.
+    """
+    # tables imports this module for redis_call()
+    from .tables import Table
+
+    if isinstance(query, bytes):
+        query = query.decode()
+
+    if not vars:
+        return ' '.join(query.split()), 0
+
+    if isinstance(vars, dict):
+        return ' '.join(query.split()), len(vars)
+
+    parts = []
+    params = 0
+    for var in vars:
+        if isinstance(var, Expression):
+            parts.append(str(var))
+            params += len(var.args)
+        elif isinstance(var, (Table, Column)):
+            parts.append(str(var))
+        elif isinstance(var, (tuple, list)) and var and all([isinstance(v, Column) for v in var]):
+            parts.append('({})'.format(', '.join([str(v) for v in var])))
+        else:
+            parts.append('%s')
+            params += len(var) if isinstance(var, (tuple, list)) else 1
+
+    try:
+        query = query % tuple(parts)
+    except (TypeError, ValueError):
+        pass
+
+    return ' '.join(query.split()), params
+
+
+@contextmanager
+def statement_template(query, params=0):
+    """
+        Report the statements run inside the block with the shape of
+        `query` and `params` values, for helpers such as execute_values()
+        and execute_batch() that inline the values into the SQL they run.
+    """
+    token = _template.set((statement_shape(query)[0], params))
+    try:
+        yield
+    finally:
+        _template.reset(token)
+
+
+class InstrumentedCursor(BaseCursor):
+    """
+        The cursor used by ConnectionPool connections, emits an Event for every statement.
+
+        A `prefix` (e.g. SET LOCAL statement_timeout) is sent in the same
+        round trip as the cursor's next statement, or on its own before a
+        COPY or the statement of a named cursor.
+    """
+
+    prefix = None
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        error = None
+        try:
+            return super().execute(self._prefixed(query), vars)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._emit(query, vars, started, error)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        error = None
+        try:
+            self._send_prefix()
+            return super().copy_expert(sql, file, size)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._emit(sql, None, started, error)
+
+    def _prefixed(self, query):
+        if self.prefix is None:
+            return query
+
+        if self.name is not None or not isinstance(query, (str, bytes)):
+            self._send_prefix()
+            return query
+
+        prefix, self.prefix = self.prefix, None
+        if isinstance(query, bytes):
+            return prefix.encode() + b'; ' + query
+        return prefix + '; ' + query
+
+    def _send_prefix(self):
+        if self.prefix is None:
+            return
+
+        prefix, self.prefix = self.prefix, None
+        with self.connection.cursor(cursor_factory=BaseCursor) as cur:
+            cur.execute(prefix)
+
+    def _emit(self, query, vars, started, error):
+        if not _hooks and _request.get() is None:
+            return
+
+        template = _template.get()
+        statement, params = template if template is not None else statement_shape(query, vars)
+        rows = self.rowcount if self.rowcount >= 0 else None
+        emit('sql', statement, params, rows, time.perf_counter() - started, error, query, vars)
+
+
+"""
+    Redis
+"""
+
+
+def redis_call(command, func, *args, **kwargs):
+    started = time.perf_counter()
+    error = None
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        emit('redis', command, len(args), None, time.perf_counter() - started, error)
+
+
+async def aredis_call(command, func, *args, **kwargs):
+    started = time.perf_counter()
+    error = None
+    try:
+        return await func(*args, **kwargs)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        emit('redis', command, len(args), None, time.perf_counter() - started, error)
+
+
+"""
+    Built-in hooks
+"""
+
+
+class SlowQueryLogger:
+    """
+        Logs a warning for every statement slower than `threshold` seconds.
+    """
+
+    def __init__(self, threshold=0.5, logger=logger):
+        self.threshold = threshold
+        self.logger = logger
+
+    def __call__(self, event):
+        if event.duration < self.threshold:
+            return
+
+        self.logger.warning(
+            "slow %s (%.3fs, wait %s, %s.%s): %s",
+            event.kind,
+            event.duration,
+            '{:.3f}s'.format(event.wait) if event.wait is not None else '-',
+            event.model,
+            event.method,
+            event.statement
+        )
+
+
+class QueryCounter:
+    """
+        Counts statements and their total duration per (model, method, kind).
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.durations = Counter()
+
+    def __call__(self, event):
+        key = (event.model, event.method, event.kind)
+        self.counts[key] += 1
+        self.durations[key] += event.duration
+
+    def reset(self):
+        self.counts.clear()
+        self.durations.clear()
+
+
+class RequestContext:
+    """
+        Counts the statements run inside a request.
+
+        A violation is recorded when more than `max_queries` statements are
+        run, or when the same statement shape is run more than `max_repeats`
+        times, which is usually an N+1 pattern. Violations are logged, and
+        raise QueryBudgetExceeded if `strict`.
+    """
+
+    def __init__(self, max_queries=None, max_repeats=None, strict=False):
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+        self.strict = strict
+        self.count = 0
+        self.duration = 0
+        self.shapes = Counter()
+        self.violations = []
+
+    def __repr__(self):
+        return "{}(count={}, violations={})".format(self.__class__.__name__, self.count, len(self.violations))
+
+    def _record(self, event):
+        self.count += 1
+        self.duration += event.duration
+        self.shapes[(event.kind, event.statement)] += 1
+
+        if self.max_queries is not None and self.count == self.max_queries + 1:
+            self._violation("query budget of {} exceeded".format(self.max_queries))
+
+        repeats = self.shapes[(event.kind, event.statement)]
+        if self.max_repeats is not None and repeats == self.max_repeats + 1:
+            self._violation("statement repeated more than {} times ({}.{}): {}".format(
+                self.max_repeats, event.model, event.method, event.statement
+            ))
+
+    def _violation(self, message):
+        self.violations.append(message)
+        logger.warning(message)
+        if self.strict:
+            raise QueryBudgetExceeded(message)
+
+
+@contextmanager
+def request_context(max_queries=None, max_repeats=None, strict=False):
+    """
+        with request_context(max_queries=50, max_repeats=5) as context:
+            handle(request)
+        print(context.count, context.violations)
+    """
+    context = RequestContext(max_queries, max_repeats, strict)
+    token = _request.set(context)
+    try:
+        yield context
+    finally:
+        _request.reset(token)
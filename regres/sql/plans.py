@@ -0,0 +1,222 @@
+"""
+    Query plans
+
+    plan = User.table.query().where(age__gt=21).explain(analyze=True)
+    print(plan.total_cost, plan.estimated_rows, plan.actual_rows, plan.seq_scans())
+
+    add_hook(PlanCapture(pool, threshold=1.0, sample_rate=0.05))
+"""
+
+from contextvars import ContextVar
+import json
+import logging
+import random
+import threading
+
+
+logger = logging.getLogger('regres')
+
+_capturing = ContextVar('regres_capturing', default=False)
+
+
+class Plan:
+    """
+        A plan returned by EXPLAIN (FORMAT JSON).
+    """
+
+    def __init__(self, plan, relation_rows=None):
+        """
+            @param plan: The first element of the EXPLAIN output
+            @param relation_rows: Relation names to their estimated number of rows (pg_class.reltuples)
+        """
+        self.raw = plan
+        self.root = plan['Plan']
+        self.relation_rows = relation_rows or dict()
+
+    def __repr__(self):
+        return "{}(node={}, total_cost={})".format(
+            self.__class__.__name__, repr(self.root['Node Type']), self.total_cost
+        )
+
+    def __str__(self):
+        return json.dumps(self.raw, indent=2)
+
+    @property
+    def total_cost(self):
+        return self.root['Total Cost']
+
+    @property
+    def estimated_rows(self):
+        return self.root['Plan Rows']
+
+    @property
+    def actual_rows(self):
+        """
+            Only available with analyze.
+        """
+        return self.root.get('Actual Rows')
+
+    @property
+    def planning_time(self):
+        return self.raw.get('Planning Time')
+
+    @property
+    def execution_time(self):
+        return self.raw.get('Execution Time')
+
+    def nodes(self):
+        """
+            @return: Every node of the plan, depth first.
+        """
+        nodes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.get('Plans', [])))
+        return nodes
+
+    def seq_scans(self, min_rows=10000):
+        """
+            @return: The sequential scans reading at least min_rows rows.
+                A scan reads the whole relation, so its size counts, not the
+                rows left after the filter. Rows removed by the filter are
+                also counted when the plan was analyzed.
+        """
+        scans = []
+        for node in self.nodes():
+            if node['Node Type'] != 'Seq Scan':
+                continue
+
+            rows = max(node['Plan Rows'], self.relation_rows.get(node.get('Relation Name'), 0))
+            if 'Actual Rows' in node:
+                scanned = (node['Actual Rows'] + node.get('Rows Removed by Filter', 0)) * node.get('Actual Loops', 1)
+                rows = max(rows, scanned)
+
+            if rows >= min_rows:
+                scans.append(node)
+        return scans
+
+    def misestimates(self, factor=10):
+        """
+            @return: The nodes whose actual rows differ from the estimate by more than factor.
+                Only available with analyze.
+        """
+        nodes = []
+        for node in self.nodes():
+            if 'Actual Rows' not in node:
+                continue
+
+            estimated = max(node['Plan Rows'], 1)
+            actual = max(node['Actual Rows'], 1)
+            if max(estimated, actual) / min(estimated, actual) > factor:
+                nodes.append(node)
+        return nodes
+
+
+def explain(pool, query, vars=None, analyze=False, buffers=False, format='json'):
+    """
+        @return: A Plan for the json format, the EXPLAIN output as text otherwise.
+    """
+    if format not in ('json', 'text', 'xml', 'yaml'):
+        raise ValueError("format must be one of 'json', 'text', 'xml' or 'yaml'")
+
+    if isinstance(query, bytes):
+        query = query.decode()
+
+    options = ['FORMAT {}'.format(format.upper())]
+    if analyze:
+        options.append('ANALYZE true')
+    if buffers:
+        options.append('BUFFERS true')
+
+    rows = pool.fetchall("EXPLAIN ({}) {}".format(', '.join(options), query), vars)
+
+    if format == 'json':
+        plan = rows[0][0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return Plan(plan[0], relation_rows(pool, Plan(plan[0])))
+
+    return '\n'.join([row[0] for row in rows])
+
+
+def relation_rows(pool, plan):
+    """
+        @return: The estimated number of rows of the relations scanned sequentially.
+            A name used in several schemas maps to the largest of them.
+    """
+    names = set([node['Relation Name'] for node in plan.nodes() if node['Node Type'] == 'Seq Scan'])
+    if not names:
+        return dict()
+
+    rows = pool.fetchall(
+        """
+            SELECT relname, max(GREATEST(reltuples, 0))
+                FROM pg_catalog.pg_class
+                WHERE relname = ANY(%s)
+                GROUP BY relname
+        """,
+        (list(names),)
+    )
+    return dict([(name, int(count)) for name, count in rows])
+
+
+class PlanCapture:
+    """
+        An instrumentation hook logging the plan of SELECT statements slower
+        than `threshold` seconds. Only a `sample_rate` fraction of them are
+        explained, and without analyze the statement isn't run again.
+
+        The plan is fetched on another connection, from a background thread
+        so the caller (or the event loop) isn't held up waiting for it.
+        Statements that are sampled while a capture is running are skipped.
+    """
+
+    def __init__(self, pool, threshold=1.0, sample_rate=0.1, analyze=False, logger=logger):
+        self.pool = pool
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.analyze = analyze
+        self.logger = logger
+        self._running = threading.Lock()
+
+    def __call__(self, event):
+        if event.kind != 'sql' or event.query is None or event.duration < self.threshold:
+            return
+
+        if not event.statement.upper().startswith('SELECT') or _capturing.get():
+            return
+
+        if random.random() >= self.sample_rate:
+            return
+
+        if not self._running.acquire(blocking=False):
+            return
+
+        try:
+            thread = threading.Thread(target=self._capture, args=(event,), name='regres-plan-capture', daemon=True)
+            thread.start()
+        except:
+            self._running.release()
+            raise
+
+    def _capture(self, event):
+        token = _capturing.set(True)
+        try:
+            plan = explain(self.pool, event.query, event.vars, analyze=self.analyze)
+        except Exception as e:
+            self.logger.debug("could not explain slow statement: %s", e)
+            return
+        finally:
+            _capturing.reset(token)
+            self._running.release()
+
+        self.logger.warning(
+            "plan of slow statement (%.3fs, %s.%s): %s\n%s",
+            event.duration,
+            event.model,
+            event.method,
+            event.statement,
+            plan
+        )
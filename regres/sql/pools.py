@@ -1,35 +1,360 @@
-from contextlib import contextmanager
-from psycopg2.pool import SimpleConnectionPool as SCP
-from psycopg2.pool import ThreadedConnectionPool as TCP
+import asyncio
+from bisect import bisect_left
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+import itertools
+import logging
+import os
+import threading
+import time
 
+import psycopg2
+from psycopg2.extensions import (
+    POLL_OK, POLL_READ, POLL_WRITE, TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS, QueryCanceledError
+)
+from psycopg2.pool import PoolError
 
-class SimpleConnectionPool(SCP):
+from .instrumentation import InstrumentedCursor, emit, statement_shape, waited
+from .timeouts import StatementTimeout, isolated, remaining, watchdog
+
+
+logger = logging.getLogger('regres')
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class ConnectionPool:
+    """
+        A thread-safe connection pool.
+
+        When every connection is in use, getconn() waits up to `timeout`
+        seconds for one to be returned before raising PoolTimeout.
+        Connections that have been idle longer than `max_idle` seconds or
+        open longer than `max_lifetime` seconds are closed instead of reused,
+        and with `pre_ping` a connection that has been idle longer than
+        `ping_after` seconds is tested before it is handed out.
+    """
+
+    wait_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf'))
+    rate_window = 60
+
+    def __init__(self, minconn, maxconn, database='postgres', user='postgres', host='localhost', *args,
+            timeout=30, max_idle=600, max_lifetime=3600, pre_ping=True, ping_after=5, **kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.pre_ping = pre_ping
+        self.ping_after = ping_after
+        self.closed = False
+
+        self._args = args
+        self._kwargs = dict(kwargs, database=database, user=user, host=host)
+        self._orphans = []
+        self._reset()
+
+        for _ in range(self.minconn):
+            self._size += 1
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Condition()
+        self._local = threading.local()
+        self._idle = deque()
+        self._created = dict()
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._recent_checkouts = deque()
+        self._wait_histogram = [0] * len(self.wait_buckets)
+
+    def _connect(self):
+        kwargs = dict(cursor_factory=InstrumentedCursor)
+        kwargs.update(self._kwargs)
+        conn = psycopg2.connect(*self._args, **kwargs)
+        self._created[conn] = time.monotonic()
+        return conn
+
+    def _check_fork(self):
+        """
+            Connections inherited from a parent process share its sockets.
+            Closing them here would close the parent's sessions, so they are
+            kept referenced (never closed or garbage collected) and the child
+            starts with an empty pool.
+        """
+        if self._pid != os.getpid():
+            self._orphans.extend(self._created)
+            self._reset()
+
+    def _is_expired(self, conn, idle_since, now):
+        if self.max_idle is not None and now - idle_since > self.max_idle:
+            return True
+        if self.max_lifetime is not None and now - self._created[conn] > self.max_lifetime:
+            return True
+        return False
+
+    def _ping(self, conn):
+        if conn.closed:
+            return False
+        try:
+            conn.autocommit = True
+            # A plain cursor, so pings aren't reported to the instrumentation hooks.
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute('SELECT 1')
+            conn.autocommit = False
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._created.pop(conn, None)
+        if not conn.closed:
+            conn.close()
+
+    def _checkout(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        while True:
+            conn = None
+            idle_since = None
+            self._check_fork()
+
+            with self._lock:
+                while True:
+                    if self.closed:
+                        raise PoolError("connection pool is closed")
+
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        if self._is_expired(conn, idle_since, time.monotonic()):
+                            self._size -= 1
+                            self._discard(conn)
+                            conn = idle_since = None
+                            continue
+                        break
+
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout("no connection available after {} seconds".format(timeout))
+
+                    self._waiting += 1
+                    self._lock.wait(remaining)
+                    self._waiting -= 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except:
+                    self._release_slot()
+                    raise
+            elif self._should_ping(idle_since) and not self._ping(conn):
+                self._discard(conn)
+                self._release_slot()
+                continue
+
+            break
+
+        now = time.monotonic()
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._recent_checkouts.append(now)
+            self._trim_recent_checkouts(now)
+            self._wait_histogram[bisect_left(self.wait_buckets, now - started)] += 1
+
+        return conn, now - started
+
+    def _should_ping(self, idle_since):
+        return self.pre_ping and time.monotonic() - idle_since > self.ping_after
+
+    def _trim_recent_checkouts(self, now):
+        while self._recent_checkouts and now - self._recent_checkouts[0] > self.rate_window:
+            self._recent_checkouts.popleft()
+
+    def _checkin(self, conn):
+        with self._lock:
+            if self._pid != os.getpid() or conn not in self._created:
+                return
+
+            self._in_use -= 1
+
+            reusable = (
+                not self.closed
+                and not conn.closed
+                and conn.info.transaction_status == TRANSACTION_STATUS_IDLE
+                and not self._is_expired(conn, time.monotonic(), time.monotonic())
+            )
+
+            if reusable:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._size -= 1
+                self._discard(conn)
+
+            self._lock.notify()
+
+    def _release_slot(self):
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+
+    @contextmanager
+    def getconn(self, timeout=None):
+        pinned = self.pinned
+        if pinned is not None:
+            # Only the checkout of the transaction waited.
+            with waited(None):
+                yield pinned
+            return
+
+        conn, wait = self._checkout(timeout)
+        try:
+            with waited(wait):
+                yield conn
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            self._checkin(conn)
+
+    @property
+    def in_use(self):
+        return self._in_use
+
+    @property
+    def pinned(self):
+        """
+            The connection of the transaction open on this thread, if any.
+        """
+        self._check_fork()
+        return getattr(self._local, 'conn', None)
 
-    def __init__(self, minconn, maxconn, database='postgres', user='postgres', host='localhost', *args, **kwargs):
-        super().__init__(minconn, maxconn, database=database, user=user, host=host, *args, **kwargs)
-    
     @contextmanager
-    def getconn(self):
+    def transaction(self, timeout=None):
+        """
+            Pin one connection to this thread until the block exits.
+            Every statement run through the pool inside the block uses it,
+            and it is committed once at the end.
+            Nested transactions join the outer one.
+        """
+        pinned = self.pinned
+        if pinned is not None:
+            yield pinned
+            return
+
+        conn, _ = self._checkout(timeout)
+        self._local.conn = conn
+        self._local.callbacks = []
+        self._local.statement_timeout = None
         try:
-            conn = super().getconn()
             yield conn
             conn.commit()
         except:
             conn.rollback()
             raise
         finally:
-            self.putconn(conn)  
+            self._local.conn = None
+            callbacks, self._local.callbacks = self._local.callbacks, []
+            self._checkin(conn)
+
+        run_callbacks(callbacks)
+
+    def after_commit(self, callback):
+        """
+            Call `callback` once the transaction open on this thread has
+            been committed, or right away if there is none.
+            It is never called if the transaction is rolled back.
+        """
+        if self.pinned is None:
+            callback()
+        else:
+            self._local.callbacks.append(callback)
 
     @contextmanager
-    def cursor(self):
-        with self.getconn() as conn:
+    def cursor(self, name=None):
+        """
+            Statements run on the cursor are limited by the current
+            statement_timeout() and deadline(). The limit is enforced by the
+            server with SET LOCAL statement_timeout, and by cancelling the
+            statement from the client if the server doesn't.
+            The limit is sent along with the cursor's first statement.
+            Inside a transaction the previous limit is restored afterwards,
+            so it doesn't apply to the transaction's later statements.
+        """
+        seconds = remaining()
+        if seconds is not None and seconds <= 0:
+            raise StatementTimeout("deadline exceeded")
+
+        timeout = self.timeout if seconds is None else min(self.timeout, seconds)
+        with self.getconn(timeout) as conn:
+            seconds = remaining()
+            previous = None
+            handle = None
+            cur = None
             try:
-                cur = conn.cursor()
-                yield cur 
-            except:
-                raise
+                cur = conn.cursor(name)
+                if seconds is not None:
+                    previous, handle = self._limit(conn, cur, seconds)
+                yield cur
+            except QueryCanceledError as e:
+                if seconds is None or isinstance(e, StatementTimeout):
+                    raise
+                raise StatementTimeout("statement cancelled after {:.3f} seconds".format(seconds)) from e
             finally:
-                cur.close()
+                if handle is not None:
+                    watchdog.unwatch(handle)
+                if cur is not None:
+                    cur.close()
+                # Nothing to restore if no statement was run with the limit.
+                if previous is not None and conn is self.pinned and getattr(cur, 'prefix', None) is None:
+                    self._unlimit(conn, previous)
+
+    def _limit(self, conn, cur, seconds):
+        """
+            @return: The statement_timeout to restore, and the watchdog handle.
+        """
+        if seconds <= 0:
+            raise StatementTimeout("deadline exceeded")
+
+        previous = None
+        if conn is self.pinned:
+            # Read once per transaction, the limits set since are all restored to it.
+            if self._local.statement_timeout is None:
+                with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as c:
+                    c.execute("SELECT current_setting('statement_timeout')")
+                    self._local.statement_timeout = c.fetchone()[0]
+            previous = self._local.statement_timeout
+
+        setting = "SET LOCAL statement_timeout = {}".format(max(1, int(seconds * 1000)))
+        if isinstance(cur, InstrumentedCursor):
+            cur.prefix = setting
+        else:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as c:
+                c.execute(setting)
+
+        return previous, watchdog.watch(conn, seconds)
+
+    def _unlimit(self, conn, previous):
+        # An aborted transaction can't run it, and its rollback drops the limit anyway.
+        if conn.closed or conn.info.transaction_status != TRANSACTION_STATUS_INTRANS:
+            return
+
+        with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute("SELECT set_config('statement_timeout', %s, true)", (previous,))
 
     def execute(self, query, vars=None):
         with self.cursor() as cur:
@@ -45,44 +370,295 @@ class SimpleConnectionPool(SCP):
             cur.execute(query, vars)
             return cur.fetchone()
 
+    def closeall(self):
+        with self._lock:
+            self.closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._discard(conn)
+            self._lock.notify_all()
 
-class ThreadedConnectionPool(TCP):
-    def __init__(self, minconn, maxconn, database='postgres', user='postgres', host='localhost', *args, **kwargs):
-        super().__init__(minconn, maxconn, database=database, user=user, host=host, *args, **kwargs)
-    
-    @contextmanager
-    def getconn(self):
+    def reader(self):
+        """
+            @return: The pool that reads should use.
+        """
+        return self
+
+    def stats(self):
+        """
+            @return: A snapshot of the pool's usage.
+                wait_histogram maps the upper bound of each bucket in seconds
+                to the number of checkouts that waited that long.
+        """
+        with self._lock:
+            self._trim_recent_checkouts(time.monotonic())
+
+            return {
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'checkouts_per_sec': len(self._recent_checkouts) / self.rate_window,
+                'timeouts': self._timeouts,
+                'wait_histogram': dict(zip(self.wait_buckets, self._wait_histogram))
+            }
+
+
+def run_callbacks(callbacks):
+    """
+        Call every callback of a committed transaction. One failing, e.g. a
+        redis write, must not skip the others (such as a table's version
+        bump), and the commit can't be undone anyway, so failures are logged.
+    """
+    for callback in callbacks:
         try:
-            conn = super().getconn()
-            yield conn
-            conn.commit()
-        except:
-            conn.rollback()
+            callback()
+        except Exception:
+            logger.exception("after commit callback %r failed", callback)
+
+
+# Both names are kept for backwards compatibility, ConnectionPool is thread-safe.
+SimpleConnectionPool = ConnectionPool
+ThreadedConnectionPool = ConnectionPool
+
+
+class ReplicatedPool:
+    """
+        A primary pool plus read replica pools.
+
+        It can be used anywhere a ConnectionPool is: writes and transactions
+        always go to the primary, while Model.get() and Query reads use
+        reader(), which picks a replica unless a transaction is open on the
+        primary in this thread.
+
+        With `max_lag`, each replica's replay lag is checked at most every
+        `lag_check_interval` seconds and replicas lagging by more than
+        `max_lag` seconds are skipped. If no replica is usable, reads go to
+        the primary. The check runs on the reading thread, so it gives up
+        after `lag_timeout` seconds, waiting for a connection included.
+    """
+
+    strategies = ('round_robin', 'least_loaded')
+
+    lag_query = """
+        SELECT CASE
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END
+    """
+
+    def __init__(self, primary, replicas, strategy='round_robin', max_lag=None, lag_check_interval=5, lag_timeout=0.5):
+        if strategy not in self.strategies:
+            raise ValueError("strategy must be one of {}".format(self.strategies))
+
+        self.primary = primary
+        self.replicas = tuple(replicas)
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.lag_timeout = lag_timeout
+
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._lag = dict()
+
+    def __getattr__(self, name):
+        # execute, fetchall, fetchone, cursor, getconn, transaction, pinned...
+        return getattr(self.primary, name)
+
+    def reader(self):
+        if self.primary.pinned is not None:
+            return self.primary
+
+        replicas = [replica for replica in self.replicas if self._is_healthy(replica)]
+        if not replicas:
+            return self.primary
+
+        if self.strategy == 'least_loaded':
+            return min(replicas, key=lambda replica: replica.in_use)
+
+        return replicas[next(self._counter) % len(replicas)]
+
+    def lag(self, replica):
+        """
+            @return: The replay lag of the replica in seconds, or None if it is unreachable.
+            @raise PoolTimeout: If none of the replica's connections was free within lag_timeout
+        """
+        try:
+            # The caller's deadline doesn't apply, and this also limits the
+            # checkout, see ConnectionPool.cursor().
+            with isolated(self.lag_timeout):
+                row = replica.fetchone(self.lag_query)
+            return float(row[0])
+        except PoolTimeout:
             raise
-        finally:
-            self.putconn(conn)  
+        except (psycopg2.Error, PoolError):
+            return None
 
-    @contextmanager
-    def cursor(self):
-        with self.getconn() as conn:
+    def _is_healthy(self, replica):
+        if self.max_lag is None:
+            return True
+
+        now = time.monotonic()
+        lag, checked_at = self._lag.get(replica, (None, None))
+
+        if checked_at is None or now - checked_at > self.lag_check_interval:
+            # Only one thread refreshes a replica's lag, the others use the last value.
+            if self._lock.acquire(blocking=False):
+                try:
+                    lag, checked_at = self.lag(replica), now
+                    self._lag[replica] = (lag, checked_at)
+                except PoolTimeout:
+                    # A busy replica isn't an unhealthy one, keep the last value.
+                    pass
+                finally:
+                    self._lock.release()
+
+        return lag is not None and lag <= self.max_lag
+
+    def closeall(self):
+        self.primary.closeall()
+        for replica in self.replicas:
+            replica.closeall()
+
+    def stats(self):
+        return {
+            'primary': self.primary.stats(),
+            'replicas': [replica.stats() for replica in self.replicas]
+        }
+
+
+class AsyncPool:
+    """
+        A pool of psycopg2 asynchronous connections for use with asyncio.
+        Asynchronous connections are always in autocommit mode, so every
+        statement is its own transaction.
+    """
+
+    def __init__(self, minconn, maxconn, database='postgres', user='postgres', host='localhost', *args, **kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.closed = False
+        self._args = args
+        self._kwargs = dict(kwargs, database=database, user=user, host=host)
+        self._pool = []
+        self._semaphore = None
+
+    async def _connect(self):
+        conn = psycopg2.connect(*self._args, async_=True, **self._kwargs)
+        await wait(conn)
+        return conn
+
+    @asynccontextmanager
+    async def getconn(self):
+        if self.closed:
+            raise PoolError("connection pool is closed")
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.maxconn)
+
+        started = time.monotonic()
+        async with self._semaphore:
+            with waited(time.monotonic() - started):
+                conn = self._pool.pop() if self._pool else await self._connect()
+                try:
+                    yield conn
+                except BaseException:
+                    if conn.isexecuting():
+                        conn.cancel()
+                        conn.close()
+                    raise
+                finally:
+                    self._putconn(conn)
+
+    def _putconn(self, conn):
+        if conn.closed:
+            return
+
+        if self.closed or len(self._pool) >= self.minconn:
+            conn.close()
+        else:
+            self._pool.append(conn)
+
+    @asynccontextmanager
+    async def cursor(self):
+        async with self.getconn() as conn:
+            cur = conn.cursor()
             try:
-                cur = conn.cursor()
-                yield cur 
-            except:
-                raise
+                yield cur
             finally:
                 cur.close()
 
-    def execute(self, query, vars=None):
-        with self.cursor() as cur:
-            cur.execute(query, vars)
+    async def execute(self, query, vars=None):
+        async with self.cursor() as cur:
+            await self._execute(cur, query, vars)
 
-    def fetchall(self, query, vars=None):
-        with self.cursor() as cur:
-            cur.execute(query, vars)
+    async def fetchall(self, query, vars=None):
+        async with self.cursor() as cur:
+            await self._execute(cur, query, vars)
             return cur.fetchall()
 
-    def fetchone(self, query, vars=None):
-        with self.cursor() as cur:
-            cur.execute(query, vars)
+    async def fetchone(self, query, vars=None):
+        async with self.cursor() as cur:
+            await self._execute(cur, query, vars)
             return cur.fetchone()
+
+    async def _execute(self, cur, query, vars):
+        started = time.perf_counter()
+        error = None
+        seconds = remaining()
+        try:
+            if seconds is not None and seconds <= 0:
+                raise StatementTimeout("deadline exceeded")
+
+            cur.execute(query, vars)
+            if seconds is None:
+                await wait(cur.connection)
+            else:
+                try:
+                    await asyncio.wait_for(wait(cur.connection), seconds)
+                except asyncio.TimeoutError:
+                    # getconn() cancels the statement and closes the connection.
+                    raise StatementTimeout("statement cancelled after {:.3f} seconds".format(seconds))
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            statement, params = statement_shape(query, vars)
+            rows = cur.rowcount if cur.rowcount >= 0 else None
+            emit('sql', statement, params, rows, time.perf_counter() - started, error, query, vars)
+
+    def closeall(self):
+        self.closed = True
+        while self._pool:
+            self._pool.pop().close()
+
+
+async def wait(conn):
+    """
+        Wait for an asynchronous connection to be ready without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+
+    while True:
+        state = conn.poll()
+        if state == POLL_OK:
+            return
+
+        if state == POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError("poll() returned {}".format(state))
+
+        fileno = conn.fileno()
+        future = loop.create_future()
+        add(fileno, future.set_result, None)
+        try:
+            await future
+        finally:
+            remove(fileno)
+
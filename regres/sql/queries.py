@@ -1,18 +1,38 @@
+import asyncio
+import contextvars
 from copy import copy
 from functools import reduce
+import hashlib
+import pickle
+import queue
+import threading
+
+from psycopg2.extensions import adapt
+
 from .expressions import Condition, Expression, SortExpression
+from .instrumentation import aredis_call, redis_call
+from .plans import explain
+from .timeouts import statement_timeout
 
 
 class Query:
     
-    def __init__(self, table):
+    def __init__(self, table, model=None):
+        """
+            @param table: The Table to query
+            @param model: An optional Model, the results are instances of it instead of tuples
+        """
         self.table = table
+        self.model = model
         self._args = ()
         self._fields = []
         self._condition = None
         self._sort_expressions = [] 
         self._count = 0
         self._start = 0
+        self._cache = False
+        self._cache_ttl = None
+        self._prefetch = []
 
     def __contains__(self, key):
         pass
@@ -25,6 +45,15 @@ class Query:
         q = q.limit(item.stop - q._start)
         return q
 
+    def __aiter__(self):
+        """
+            async for row in query
+
+            The rows are loaded with aall() before the first one is yielded,
+            they aren't streamed. Page through large results with limit().
+        """
+        return self._aiter()
+
     def __iter__(self):
         pass
 
@@ -46,7 +75,7 @@ class Query:
         self._args = []
 
         if self._fields:
-            fields = reduce(add, self.fields)
+            fields = reduce(add, self._fields)
             query = "SELECT %s"
             self._args = [fields]
         else:
@@ -58,10 +87,10 @@ class Query:
 
         if self._condition:
             query = "{} WHERE %s".format(query)
-            self._args.append(self.condition)
+            self._args.append(self._condition)
 
         if self._sort_expressions:
-            expression = reduce(add, self.sort_expressions)
+            expression = reduce(add, self._sort_expressions)
             query = "{} ORDER BY %s".format(query)
             self._args.append(expression)
 
@@ -83,12 +112,13 @@ class Query:
 
     def where(self, *args, **kwargs):
         #add logic for clearing condition
+        q = self
 
         if args:
-            q = self._filter_by_args(*args)
+            q = q._filter_by_args(*args)
 
         if kwargs:
-            q = self._filter_by_kwargs(**kwargs)
+            q = q._filter_by_kwargs(**kwargs)
 
         return q
 
@@ -108,12 +138,102 @@ class Query:
         q._start = 0 if not start or start < 0 else start 
         return q
 
-    def all(self):
-        rows = self.table._pool.fetchall(self.query, self._args)
-        return rows
+    def cache(self, ttl=300):
+        """
+            Cache the results of all() and aall() in Redis.
+            Entries are keyed by the table's version, so any write to the
+            table through a Model makes previously cached results unreachable.
+            They are never deleted, only left to expire.
+            @param ttl: expiration of the cached results in seconds
+        """
+        if not ttl or ttl < 0:
+            raise ValueError("ttl must be a positive number of seconds")
+
+        if self.table._conn is None:
+            raise ValueError("Table '{}' has no redis connection.".format(self.table._name))
+
+        q = self.copy()
+        q._cache = True
+        q._cache_ttl = ttl
+        return q
+
+    def prefetch(self, *relations, **models):
+        """
+            Load the related rows of all the results with one query per relation,
+            and set them as attributes of the instances.
+            e.g. Pet.query().prefetch('owner') sets pet.owner for every pet.
+            @param *relations: Names of relations, see ForeignKey
+            @param **models: Relation names to the Model to load them as, defaults
+                to the first Model declared for the referenced table
+        """
+        if self.model is None:
+            raise ValueError("prefetch() requires a query created with Model.query()")
+
+        q = self.copy()
+        q._prefetch.extend([(relation, None) for relation in relations])
+        q._prefetch.extend(models.items())
+        return q
+
+    def explain(self, analyze=False, buffers=False, format='json'):
+        """
+            @param analyze: Run the query to get actual rows and timings
+            @param buffers: Include buffer usage, requires analyze
+            @param format: 'json' returns a Plan, 'text', 'xml' and 'yaml' return the output as is
+        """
+        return explain(self.table._read_pool, self.query, self._args, analyze, buffers, format)
+
+    def copy_to(self, file_obj=None, format='csv', header=True, size=65536):
+        """
+            Export the results with COPY (...) TO STDOUT, without creating a
+            Python object per row.
+            @param file_obj: A file-like object to write to. When None, a
+                generator of bytes chunks of about `size` bytes is returned.
+            @param format: 'csv', 'text' or 'binary'
+            @param header: Whether to write a header line, csv only
+        """
+        if format not in ('csv', 'text', 'binary'):
+            raise ValueError("format must be one of 'csv', 'text' or 'binary'")
+
+        options = ['FORMAT {}'.format(format)]
+        if header and format == 'csv':
+            options.append('HEADER true')
+
+        if file_obj is None:
+            return self._copy_chunks(options, size)
+
+        self._copy(file_obj, options, size)
+
+    def copy(self):
+        q = copy(self)
+        q._fields = list(self._fields)
+        q._sort_expressions = list(self._sort_expressions)
+        q._prefetch = list(self._prefetch)
+        return q
 
-    def one(self):
-        row = self.table._pool.fetchone(self.query, self._args)
+    def all(self, timeout=None):
+        """
+            @param timeout: Seconds each statement may run for, defaults to the model's timeout
+        """
+        with self._statement_timeout(timeout):
+            if self._uses_cache():
+                rows = self._all_from_cache()
+            else:
+                rows = self.table._read_pool.fetchall(self.query, self._args)
+
+            return self._to_models(rows)
+
+    async def aall(self, timeout=None):
+        with self._statement_timeout(timeout):
+            if self._uses_cache():
+                rows = await self._aall_from_cache()
+            else:
+                rows = await self.table._async_pool.fetchall(self.query, self._args)
+
+            return await self._ato_models(rows)
+
+    def one(self, timeout=None):
+        with self._statement_timeout(timeout):
+            row = self.table._read_pool.fetchone(self.query, self._args)
         return row
 
     def count(self):
@@ -122,6 +242,129 @@ class Query:
         row = self.one()
         return row[0]
 
+    async def _aiter(self):
+        for row in await self.aall():
+            yield row
+
+    def _statement_timeout(self, timeout):
+        if timeout is None and self.model is not None:
+            timeout = self.model.timeout
+        return statement_timeout(timeout)
+
+    def _to_models(self, rows):
+        if self.model is None:
+            return rows
+
+        instances = [self.model._from_row(row) for row in rows]
+        for relation, model in self._prefetch:
+            self.model._prefetch(instances, relation, model)
+        return instances
+
+    async def _ato_models(self, rows):
+        if self.model is None:
+            return rows
+
+        instances = [self.model._from_row(row) for row in rows]
+        for relation, model in self._prefetch:
+            await self.model._aprefetch(instances, relation, model)
+        return instances
+
+    def _copy(self, file_obj, options, size):
+        with self.table._read_pool.cursor() as cur:
+            query = cur.mogrify(self.query, self._args).decode()
+            sql = "COPY ({}) TO STDOUT WITH ({})".format(query, ', '.join(options))
+
+            if not isinstance(file_obj, _ChunkWriter):
+                cur.copy_expert(sql, file_obj, size)
+                return
+
+            # Only cancel while the COPY runs, the connection goes back to the pool afterwards.
+            file_obj.conn = cur.connection
+            try:
+                cur.copy_expert(sql, file_obj, size)
+            finally:
+                file_obj.conn = None
+
+    def _copy_chunks(self, options, size):
+        """
+            COPY pushes rows into a file, so it runs in a thread writing
+            into a bounded queue that the generator reads from.
+        """
+        writer = _ChunkWriter(size)
+        context = contextvars.copy_context()
+
+        def run():
+            try:
+                context.run(self._copy, writer, options, size)
+                writer.flush()
+                writer.put(None)
+            except BaseException as e:
+                # Once the generator is closed nobody reads the queue anymore.
+                if writer.stop.is_set():
+                    return
+                try:
+                    writer.put(e)
+                except IOError:
+                    pass
+
+        thread = threading.Thread(target=run, name='regres-copy', daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                chunk = writer.chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+        finally:
+            writer.stop.set()
+            thread.join()
+
+    def _uses_cache(self):
+        """
+            Inside a transaction the rows may be uncommitted, and a cached
+            result wouldn't include the transaction's own writes.
+        """
+        return self._cache and self.table._pool.pinned is None
+
+    def _all_from_cache(self):
+        conn = self.table._conn
+        key = self._cache_key(self.table._cache_version())
+
+        rows = redis_call('GET', conn.get, key)
+        if rows is not None:
+            return pickle.loads(rows)
+
+        # A replica could return rows older than the version they would be cached under.
+        rows = self.table._pool.fetchall(self.query, self._args)
+        redis_call('SET', conn.set, key, pickle.dumps(rows), ex=self._cache_ttl)
+        return rows
+
+    async def _aall_from_cache(self):
+        conn = self.table._async_conn
+        if conn is None:
+            # Don't block the event loop on the synchronous connection.
+            context = contextvars.copy_context()
+            return await asyncio.get_running_loop().run_in_executor(None, context.run, self._all_from_cache)
+
+        key = self._cache_key(await self.table._acache_version())
+
+        rows = await aredis_call('GET', conn.get, key)
+        if rows is not None:
+            return pickle.loads(rows)
+
+        rows = await self.table._async_pool.fetchall(self.query, self._args)
+        await aredis_call('SET', conn.set, key, pickle.dumps(rows), ex=self._cache_ttl)
+        return rows
+
+    def _cache_key(self, version):
+        query = ' '.join(self.query.split())
+        args = tuple([adapt(arg).getquoted().decode() for arg in self._args])
+        digest = hashlib.sha1((query % args).encode()).hexdigest()
+        return "regres:query:{}:{}:{}".format(self.table, version, digest)
+
     def _filter_by_args(self, *args):
         if not all([type(arg) == Condition for arg in args]):
             raise TypeError("args must be of type '{}'".format(Condition.__name__))
@@ -138,5 +381,55 @@ class Query:
 
         return q
 
-    def _filter_by_kwargs(**kwargs):
-        pass
\ No newline at end of file
+    def _filter_by_kwargs(self, **kwargs):
+        """
+            Keys are column names, optionally followed by a lookup
+            e.g. where(age__gt=21, name__like='R%')
+        """
+        conditions = []
+        for key, value in kwargs.items():
+            name, _, lookup = key.partition('__')
+            conditions.append(self.table[name][lookup or 'eq'](value))
+
+        return self._filter_by_args(*conditions)
+
+
+class _ChunkWriter:
+    """
+        A file-like object buffering the rows written by COPY into chunks of
+        about `size` bytes, for a consumer in another thread.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.chunks = queue.Queue(maxsize=8)
+        self.stop = threading.Event()
+        self.conn = None
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self._buffer:
+            self.put(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+        # The generator was closed. Raising alone would leave the rest of the
+        # result to be read and discarded by the rollback, so the server is
+        # asked to stop sending it first.
+        if self.conn is not None:
+            self.conn.cancel()
+        raise IOError("copy_to() consumer stopped reading")
+
@@ -1,49 +1,76 @@
+import asyncio
+import contextvars
 import copy
 
 from psycopg2.extensions import AsIs, adapt, register_adapter
 
 from .columns import Column
+from .instrumentation import aredis_call, redis_call
 from .queries import Query
 
-class Table:
-    def __init__(self, name, pool, schema='public'):
-        self._schema = schema #maybe change to table_schema
-        self._name = name # maybe change to table_name
-        self._pool = pool
 
-        query = """
-            SELECT a.column_name, c.constraint_type 
-                FROM information_schema.columns AS a
-                    LEFT JOIN information_schema.key_column_usage AS b
-                        ON a.table_schema = b.table_schema 
-                        AND a.table_name = b.table_name
-                        AND a.column_name = b.column_name
-                    LEFT JOIN information_schema.table_constraints AS c
-                        ON b.table_schema = c.table_schema
-                        AND b.table_name = c.table_name
-                        AND b.constraint_name = c.constraint_name
-                WHERE a.table_schema = %s AND a.table_name = %s
-                ORDER BY a.ordinal_position ASC
+class ForeignKey:
+    """
+        A single column foreign key.
+        It is named after its column without the '_id' suffix, or after
+        its column and the referenced table if the column has no such
+        suffix, e.g. 'created_by' referencing users is 'created_by_users'.
+    """
+
+    def __init__(self, column, schema, table_name, references):
+        """
+            @param column: The referencing Column
+            @param schema: The schema of the referenced table
+            @param table_name: The name of the referenced table
+            @param references: The name of the referenced column
         """
+        self.column = column
+        self.schema = schema
+        self.table_name = table_name
+        self.references = references
 
-        rows = self._pool.fetchall(query, (self._schema, self._name))
+    def __repr__(self):
+        return "{}(name={})".format(self.__class__.__name__, repr(self.name))
 
-        if not rows:
-            raise Exception("Table '{}' does not exist.".format(self._name))
-        
-        if rows:
-            self._columns = list()
-            for row in rows:
-                col_name = row[0]
-                col = Column(col_name, self)
-                
-                setattr(self, col._attr_name, col)
-                self._columns.append(col)
+    @property
+    def name(self):
+        if self.column.name.endswith('_id'):
+            return self.column.name[:-len('_id')]
+        return '{}_{}'.format(self.column.name, self.table_name)
+
+
+class Table:
+    def __init__(self, name, pool, schema='public', conn=None, async_pool=None, database=None, async_conn=None):
+        """
+            The columns of the table are reflected from the database the
+            first time they are needed, not when the table is created.
 
-                if row[1] == 'PRIMARY KEY':
-                    self._primary_key = col
+            @param name: The name of the table
+            @param pool: The connection pool used to query the table
+            @param schema: The schema of the table
+            @param conn: An optional redis connection used for caching queries
+            @param async_pool: An optional AsyncPool used by the async methods
+            @param database: An optional Database to reflect the table from
+            @param async_conn: An optional asyncio redis connection used by the async methods
+                to invalidate cached queries, instead of conn
+        """
+        self._schema = schema #maybe change to table_schema
+        self._name = name # maybe change to table_name
+        self._pool = pool
+        self._conn = conn
+        self._async_pool = async_pool
+        self._async_conn = async_conn
+        self._database = database
+        self._reflected = False
 
-            self._columns = tuple(self._columns)
+    def __getattr__(self, name):
+        # Only called for attributes that don't exist yet, i.e. the columns
+        # of a table that hasn't been reflected.
+        if name.startswith('__') or self.__dict__.get('_reflected', True):
+            raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, name))
+
+        self._reflect()
+        return getattr(self, name)
 
     def __contains__(self, item):
         return item in self.columns
@@ -78,9 +105,164 @@ class Table:
     def primary_key(self):
         return self._primary_key
 
+    def _relations(self):
+        """
+            @return: A dict of relation name to ForeignKey.
+                A relation is read as an attribute of the instances, so one
+                sharing its name with a column or another relation is left out.
+                A method rather than a property, so a column can be named 'relations'.
+        """
+        names = [fk.name for fk in self._foreign_keys]
+        return dict([
+            (fk.name, fk) for fk in self._foreign_keys
+            if names.count(fk.name) == 1 and fk.name not in self.column_names
+        ])
+
+    @property
+    def _read_pool(self):
+        """
+            The pool that reads should use, a replica when the pool has any.
+        """
+        return self._pool.reader()
+
+    def _cache_version(self):
+        """
+            The number of writes made to the table through a Model.
+            Used to invalidate cached queries. A method rather than a
+            property, so a column can be named 'version'.
+        """
+        if self._conn is None:
+            return None
+
+        version = redis_call('GET', self._conn.get, self._version_key)
+        return int(version) if version is not None else 0
+
+    async def _acache_version(self):
+        if self._async_conn is None:
+            return self._cache_version()
+
+        version = await aredis_call('GET', self._async_conn.get, self._version_key)
+        return int(version) if version is not None else 0
+
+    @property
+    def _version_key(self):
+        return "regres:version:{}".format(self)
+
     def query(self):
         return Query(self)
 
+    def _reflect(self):
+        if self._database is not None:
+            metadata = self._database._metadata(self._name)
+        else:
+            metadata = reflect(self._pool, self._schema, self._name).get(self._name)
+
+        if metadata is None:
+            raise Exception("Table '{}' does not exist.".format(self._name))
+
+        self._bind(metadata)
+
+    def _bind(self, metadata):
+        """
+            @param metadata: A dict with the table's 'columns', 'primary_key' and 'foreign_keys'
+        """
+        columns = dict()
+        for col_name in metadata['columns']:
+            col = Column(col_name, self)
+
+            setattr(self, col._attr_name, col)
+            columns[col_name] = col
+
+            if col_name == metadata['primary_key']:
+                self._primary_key = col
+
+        self._columns = tuple(columns.values())
+        self._foreign_keys = tuple([
+            ForeignKey(columns[fk['column']], fk['schema'], fk['table'], fk['references'])
+            for fk in metadata.get('foreign_keys', [])
+        ])
+        self._reflected = True
+
+    def _bump_version(self):
+        if self._conn is not None:
+            redis_call('INCR', self._conn.incr, self._version_key)
+
+    async def _abump_version(self):
+        if self._async_conn is not None:
+            await aredis_call('INCR', self._async_conn.incr, self._version_key)
+        elif self._conn is not None:
+            # Don't block the event loop on the synchronous connection.
+            context = contextvars.copy_context()
+            await asyncio.get_running_loop().run_in_executor(None, context.run, self._bump_version)
+
+
+def reflect(pool, schema='public', name=None):
+    """
+        Load the columns, primary keys and foreign keys of every table in a schema.
+        @param name: Only load this table
+        @return: A dict of table name to {'columns': [...], 'primary_key': ..., 'foreign_keys': [...]}
+    """
+    query = """
+        SELECT c.relname, a.attname, COALESCE(a.attnum = ANY(p.conkey), false)
+            FROM pg_catalog.pg_attribute AS a
+                JOIN pg_catalog.pg_class AS c
+                    ON c.oid = a.attrelid
+                JOIN pg_catalog.pg_namespace AS n
+                    ON n.oid = c.relnamespace
+                LEFT JOIN pg_catalog.pg_constraint AS p
+                    ON p.conrelid = c.oid
+                    AND p.contype = 'p'
+            WHERE n.nspname = %s
+                AND (%s IS NULL OR c.relname = %s)
+                AND c.relkind IN ('r', 'v', 'm', 'p', 'f')
+                AND a.attnum > 0
+                AND NOT a.attisdropped
+            ORDER BY c.relname, a.attnum
+    """
+
+    # Foreign keys spanning several columns are not supported.
+    foreign_keys_query = """
+        SELECT c.relname, a.attname, rn.nspname, rc.relname, ra.attname
+            FROM pg_catalog.pg_constraint AS f
+                JOIN pg_catalog.pg_class AS c
+                    ON c.oid = f.conrelid
+                JOIN pg_catalog.pg_namespace AS n
+                    ON n.oid = c.relnamespace
+                JOIN pg_catalog.pg_attribute AS a
+                    ON a.attrelid = f.conrelid
+                    AND a.attnum = f.conkey[1]
+                JOIN pg_catalog.pg_class AS rc
+                    ON rc.oid = f.confrelid
+                JOIN pg_catalog.pg_namespace AS rn
+                    ON rn.oid = rc.relnamespace
+                JOIN pg_catalog.pg_attribute AS ra
+                    ON ra.attrelid = f.confrelid
+                    AND ra.attnum = f.confkey[1]
+            WHERE f.contype = 'f'
+                AND array_length(f.conkey, 1) = 1
+                AND n.nspname = %s
+                AND (%s IS NULL OR c.relname = %s)
+            ORDER BY c.relname, a.attnum
+    """
+
+    tables = dict()
+    for table_name, col_name, is_primary_key in pool.fetchall(query, (schema, name, name)):
+        table = tables.setdefault(table_name, {'columns': [], 'primary_key': None, 'foreign_keys': []})
+        table['columns'].append(col_name)
+        if is_primary_key:
+            table['primary_key'] = col_name
+
+    for table_name, col_name, ref_schema, ref_table, ref_col in pool.fetchall(foreign_keys_query, (schema, name, name)):
+        if table_name in tables:
+            tables[table_name]['foreign_keys'].append({
+                'column': col_name,
+                'schema': ref_schema,
+                'table': ref_table,
+                'references': ref_col
+            })
+
+    return tables
+
 
 def adapt_table(table):
     return AsIs(str(table))
@@ -0,0 +1,169 @@
+"""
+    Statement timeouts and request deadlines
+
+    with deadline(2.0):
+        handle(request)  # no statement can run past 2 seconds from now
+
+    with statement_timeout(0.5):
+        query.all()  # each statement can run for at most 0.5 seconds
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import heapq
+import itertools
+import threading
+import time
+
+from psycopg2.extensions import QueryCanceledError
+
+
+_deadline = ContextVar('regres_deadline', default=None)
+_timeout = ContextVar('regres_timeout', default=None)
+
+
+class StatementTimeout(QueryCanceledError):
+    pass
+
+
+@contextmanager
+def deadline(seconds):
+    """
+        Statements run inside the block are cancelled once `seconds` have passed.
+        A nested deadline can't extend the outer one.
+    """
+    at = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        at = min(at, outer)
+
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def statement_timeout(seconds):
+    """
+        Each statement run inside the block is cancelled after `seconds`.
+        With None the timeout of the enclosing block, if any, is kept.
+    """
+    if seconds is None:
+        yield
+        return
+
+    token = _timeout.set(seconds)
+    try:
+        yield
+    finally:
+        _timeout.reset(token)
+
+
+@contextmanager
+def isolated(seconds):
+    """
+        Each statement run inside the block is cancelled after `seconds`,
+        regardless of the enclosing deadline or timeout. For statements
+        run on behalf of the pool rather than of the caller.
+    """
+    deadline_token = _deadline.set(None)
+    timeout_token = _timeout.set(seconds)
+    try:
+        yield
+    finally:
+        _timeout.reset(timeout_token)
+        _deadline.reset(deadline_token)
+
+
+def remaining():
+    """
+        @return: The seconds a statement may run for from now, or None if unlimited.
+    """
+    timeout = _timeout.get()
+    at = _deadline.get()
+
+    if at is None:
+        return timeout
+
+    left = at - time.monotonic()
+    return left if timeout is None else min(timeout, left)
+
+
+class Watchdog:
+    """
+        A single thread cancelling the statements that outlive their deadline,
+        for when the server can't enforce statement_timeout itself
+        (e.g. the network stalls).
+
+        A statement is only cancelled `grace` seconds after its deadline,
+        so the server's own timeout normally fires first. Once unwatch()
+        returns, the connection can be reused without being cancelled: it
+        waits for a cancel of that connection already in progress. The
+        cancel itself opens a connection to the server, so it runs outside
+        the lock and a stalled one only holds up its own statement.
+    """
+
+    def __init__(self, grace=0.5):
+        self.grace = grace
+        self._lock = threading.Condition()
+        self._heap = []
+        self._active = dict()
+        self._cancelling = dict()
+        self._counter = itertools.count()
+        self._thread = None
+
+    def watch(self, conn, seconds):
+        """
+            @return: A handle to pass to unwatch() once the statement is done.
+        """
+        handle = next(self._counter)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='regres-watchdog', daemon=True)
+                self._thread.start()
+
+            self._active[handle] = conn
+            heapq.heappush(self._heap, (time.monotonic() + seconds + self.grace, handle))
+            self._lock.notify()
+        return handle
+
+    def unwatch(self, handle):
+        with self._lock:
+            self._active.pop(handle, None)
+            cancelling = self._cancelling.get(handle)
+
+        if cancelling is not None:
+            cancelling.wait()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._heap:
+                    self._lock.wait()
+
+                at, handle = self._heap[0]
+                now = time.monotonic()
+                if at > now:
+                    self._lock.wait(at - now)
+                    continue
+
+                heapq.heappop(self._heap)
+                conn = self._active.pop(handle, None)
+                if conn is None or conn.closed:
+                    continue
+
+                cancelling = self._cancelling[handle] = threading.Event()
+
+            try:
+                conn.cancel()
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    del self._cancelling[handle]
+                cancelling.set()
+
+
+watchdog = Watchdog()
@@ -8,12 +8,21 @@
 
 """
 
+import asyncio
+from contextlib import contextmanager
+import io
+import os
+import threading
+import time
+
 import redis 
 from psycopg2 import connect
 
 from regres import *
+from regres.sql.instrumentation import QueryCounter, add_hook, remove_hook, request_context
 
 pool = SimpleConnectionPool(2,3)
+async_pool = AsyncPool(1,2)
 redis_conn = redis.Redis()
 
 
@@ -21,11 +30,67 @@ class User(Model):
     table = Table('users', pool)
 
 
+class CachedUser(Model):
+    table = Table('users', pool, conn=redis_conn)
+
+
+class AsyncUser(Model):
+    table = Table('users', pool, async_pool=async_pool)
+
+
+class Dog(Model):
+    table = Table('dogs', pool)
+
+
+class AsyncDog(Model):
+    table = Table('dogs', pool, async_pool=async_pool)
+
+
+class HybridUser(HybridModel):
+    conn = redis_conn
+    table = Table('users', pool)
+
+
 class Pet(RedisModel):
     conn = redis_conn
     expire = 300
 
 
+class StubCopyPool:
+    """
+        Records when its connection is checked out, cancelled and checked in.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def reader(self):
+        return self
+
+    def cancel(self):
+        self.events.append('cancel')
+
+    @contextmanager
+    def cursor(self):
+        self.events.append('checkout')
+        try:
+            yield StubCopyCursor(self)
+        finally:
+            self.events.append('checkin')
+
+
+class StubCopyCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def mogrify(self, query, args):
+        return b'SELECT 1'
+
+    def copy_expert(self, sql, file_obj, size):
+        while True:
+            file_obj.write(b'x' * size)
+
+
 if __name__ == '__main__':
     r = redis.Redis()
     conn = connect(dbname='postgres', user='postgres', host='localhost')
@@ -79,5 +144,349 @@ if __name__ == '__main__':
     pet.delete()
     assert len(r.keys()) == 0
 
+    # Test cache warming
+
+    users = [HybridUser(name=name, age=27) for name in ['Ryan', 'Kroon', 'Leo']]
+    for user in users:
+        user.save()
+    r.flushdb()
+
+    assert HybridUser.warm(batch_size=2) == users[-1].pk
+    assert len(r.keys()) == 3
+    r.flushdb()
+
+    assert HybridUser.warm(HybridUser.table.query().where(name='Kroon')) == users[1].pk
+    assert r.keys() == [users[1]._key.encode()]
+    r.flushdb()
+
+    try:
+        HybridUser.warm(HybridUser.table.query().offset(1))
+        assert False
+    except ValueError:
+        pass
+    assert len(r.keys()) == 0
+
+    HybridUser.warm([users[0].pk, users[2].pk], after=users[0].pk)
+    assert r.keys() == [users[2]._key.encode()]
+    r.flushdb()
+
+    from regres.__main__ import main
+    main(['warm', '__main__:HybridUser', '--after', str(users[0].pk), '--batch-size', '1'])
+    assert len(r.keys()) == 2
+
+    for user in users:
+        user.delete()
+    assert len(r.keys()) == 0
+
+    # Test Query cache
+
+    query = CachedUser.table.query().cache(ttl=60)
+    assert query.all() == []
+
+    user = CachedUser(name='Ryan', age=27)
+    user.save()
+    assert len(query.all()) == 1
+
+    user.delete()
+    assert query.all() == []
+
+    try:
+        with pool.transaction():
+            CachedUser(name='Ryan', age=27).save()
+            assert len(query.all()) == 1
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert query.all() == []
+    r.flushdb()
+
+    # Test transaction
+
+    with transaction(pool) as session:
+        ryan = User(name='Ryan', age=27)
+        kroon = User(name='Kroon', age=28)
+        ryan.save()
+        kroon.save()
+        assert ryan.pk is None
+
+    assert ryan.pk is not None and kroon.pk is not None
+
+    try:
+        with transaction(pool):
+            ryan.delete()
+            kroon.delete()
+            raise RuntimeError
+    except RuntimeError:
+        pass
+
+    assert len(User.get_many()) == 2
+
+    with transaction(pool):
+        ryan.delete()
+        kroon.delete()
+
+    assert User.get_many() == []
+
+    committed = []
+    with pool.transaction():
+        with transaction(pool) as session:
+            session.on_commit(lambda: committed.append(True))
+        assert committed == []
+    assert committed == [True]
+
+    def fail():
+        raise RuntimeError
+
+    committed = []
+    with transaction(pool) as session:
+        session.on_commit(fail)
+        session.on_commit(lambda: committed.append(True))
+    assert committed == [True]
+
+    try:
+        with pool.transaction():
+            HybridUser(name='Ryan', age=27).save()
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert len(r.keys()) == 0 and User.get_many() == []
+
+    hybrid = HybridUser(name='Ryan', age=27)
+    hybrid.save()
+    with transaction(pool):
+        hybrid.name = 'Kroon'
+        hybrid.save()
+        assert HybridUser.get(hybrid.pk).name == 'Kroon'
+    assert HybridUser.get(hybrid.pk).name == 'Kroon'
+    hybrid.delete()
+
+    # Test connection pool
+
+    small = SimpleConnectionPool(1, 1, timeout=0.1)
+    with small.getconn():
+        try:
+            with small.getconn():
+                assert False
+        except PoolTimeout:
+            pass
+
+    def hold():
+        with small.getconn():
+            time.sleep(0.2)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    time.sleep(0.05)
+    with small.getconn(timeout=1):
+        pass
+    thread.join()
+
+    stats = small.stats()
+    assert stats['checkouts'] == 3 and stats['timeouts'] == 1
+    assert stats['in_use'] == 0 and stats['idle'] == 1
+    assert stats['wait_histogram'][0.5] == 1
+
+    recycled = SimpleConnectionPool(1, 1, max_idle=0)
+    with recycled.getconn() as first:
+        pass
+    time.sleep(0.01)
+    with recycled.getconn() as second:
+        pass
+    assert first.closed and second is not first
+
+    pid = os.fork()
+    if pid == 0:
+        with small.getconn() as child:
+            ok = child not in small._orphans and not child.closed
+        os._exit(0 if ok and small.fetchone("SELECT 1") == (1,) else 1)
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    assert small.fetchone("SELECT 1") == (1,)
+
+    # Test read replica routing
+
+    replica = SimpleConnectionPool(1,2)
+    replicated = ReplicatedPool(pool, [replica], max_lag=10)
+    assert replicated.reader() is replica
+
+    with replicated.transaction():
+        assert replicated.reader() is pool
+
+    replicated._lag.clear()
+    with deadline(0):
+        assert replicated.reader() is replica
+    assert replicated._lag[replica][0] is not None
+
+    # Test Database reflection
+
+    db = Database(pool, snapshot='/tmp/regres_schema.json')
+    users = db.table('users')
+    assert users._reflected == False
+    assert 'name' in users.column_names
+    assert users.primary_key.name == 'id'
+    assert db.reflect() == Database(pool, snapshot='/tmp/regres_schema.json').reflect()
+
+    checksum = db.checksum()
+    cur.execute("ALTER TABLE users RENAME TO members")
+    conn.commit()
+    try:
+        assert db.checksum() != checksum
+    finally:
+        cur.execute("ALTER TABLE members RENAME TO users")
+        conn.commit()
+
+    # Test instrumentation
+
+    counter = QueryCounter()
+    add_hook(counter)
+
+    with request_context(max_repeats=2) as context:
+        for name in ['Ryan', 'Kroon', 'Leo']:
+            User(name=name, age=27).save()
+
+    remove_hook(counter)
+    assert counter.counts[('User', 'save', 'sql')] == 3
+    assert context.count == 3
+    assert len(context.violations) == 1
+
+    for user in User.get_many():
+        user.delete()
+
+    events = []
+    hook = events.append
+    add_hook(hook)
+    with transaction(pool):
+        User(name='Ryan', age=27).save()
+        User(name='Kroon', age=28).save()
+    remove_hook(hook)
+    assert [event.statement.startswith('INSERT') and event.params for event in events] == [4]
+    assert 'Ryan' not in events[0].statement and events[0].wait is None
+
+    for user in User.get_many():
+        user.delete()
+
+    # Test statement timeouts
+
+    try:
+        with statement_timeout(0.1):
+            pool.fetchone("SELECT pg_sleep(1)")
+        assert False
+    except StatementTimeout:
+        pass
+
+    try:
+        with deadline(0.1):
+            User.get_many(timeout=5)
+            pool.fetchone("SELECT pg_sleep(1)")
+        assert False
+    except StatementTimeout:
+        pass
+
+    with transaction(pool):
+        User.get_many(timeout=0.1)
+        pool.fetchone("SELECT pg_sleep(0.3)")
+
+    with statement_timeout(1):
+        assert pool.fetchone("SHOW statement_timeout") == ('1s',)
+
+    with pool.transaction():
+        with statement_timeout(1):
+            assert pool.fetchone("SHOW statement_timeout") == ('1s',)
+        assert pool.fetchone("SHOW statement_timeout") == ('0',)
+
+    # Test COPY export
+
+    User(name='Ryan', age=27).save()
+
+    f = io.BytesIO()
+    User.table.query().copy_to(f)
+    lines = f.getvalue().splitlines()
+    assert len(lines) == 2 and lines[0].startswith(b'id')
+
+    chunks = User.table.query().where(name='Ryan').copy_to(header=False)
+    assert b''.join(chunks).count(b'Ryan') == 1
+
+    stub = StubCopyPool()
+    chunks = Table('numbers', stub).query().copy_to(size=1024)
+    next(chunks)
+    chunks.close()
+    assert stub.events == ['checkout', 'cancel', 'checkin']
+
+    cur.execute("CREATE TABLE numbers AS SELECT generate_series(1, 3000000) AS n")
+    conn.commit()
+    chunks = Table('numbers', pool).query().copy_to(size=1024)
+    next(chunks)
+    started = time.monotonic()
+    chunks.close()
+    assert time.monotonic() - started < 0.5
+    cur.execute("DROP TABLE numbers")
+    conn.commit()
+
+    for user in User.get_many():
+        user.delete()
+
+    # Test explain
+
+    plan = User.table.query().where(name='Ryan').explain(analyze=True)
+    assert plan.total_cost > 0
+    assert plan.actual_rows == 0
+    assert 'Seq Scan' in User.table.query().explain(format='text')
+
+    cur.execute("CREATE TABLE numbers AS SELECT generate_series(1, 20000) AS n")
+    cur.execute("ANALYZE numbers")
+    conn.commit()
+    plan = Table('numbers', pool).query().where(n=-1).explain()
+    assert plan.estimated_rows < 10 and len(plan.seq_scans(10000)) == 1
+    cur.execute("DROP TABLE numbers")
+    conn.commit()
+
+    # Test prefetch
+
+    cur.execute("CREATE TABLE IF NOT EXISTS dogs (id serial PRIMARY KEY, name text, owner_id integer REFERENCES users (id))")
+    conn.commit()
+
+    ryan = User(name='Ryan', age=27)
+    ryan.save()
+    for name, owner_id in [('Leo', ryan.pk), ('Max', ryan.pk), ('Rex', None)]:
+        Dog(name=name, owner_id=owner_id).save()
+
+    with request_context() as context:
+        dogs = Dog.get_many(prefetch='owner')
+    assert context.count == 2
+    assert sorted([(dog.name, dog.owner and dog.owner.name) for dog in dogs]) == [
+        ('Leo', 'Ryan'), ('Max', 'Ryan'), ('Rex', None)
+    ]
+    assert 'owner' not in dogs[0].to_dict()
+    assert not hasattr(Dog.from_pickle(dogs[0].to_pickle()), 'owner')
+
+    async def test_async_prefetch():
+        dogs = await AsyncDog.query().where(name='Leo').prefetch(owner=AsyncUser).aall()
+        assert dogs[0].owner.name == 'Ryan'
+
+    asyncio.run(test_async_prefetch())
+
+    cur.execute("DROP TABLE dogs")
+    conn.commit()
+    ryan.delete()
+
+    # Test async Model
+
+    async def test_async_user():
+        user = AsyncUser(name='Ryan', age=27)
+        assert await user.asave() == True
+
+        user = await AsyncUser.aget(user.pk)
+        assert user.name == 'Ryan'
+
+        users = await AsyncUser.aget_many(name='Ryan')
+        assert len(users) == 1
+
+        assert await user.adelete() == True
+        assert await AsyncUser.table.query().aall() == []
+        cached = Table('users', pool, conn=redis_conn, async_pool=async_pool).query().cache(ttl=60)
+        assert await cached.aall() == []
+
+    asyncio.run(test_async_user())
+
 
 